@@ -0,0 +1,235 @@
+# Adaptive attack budgets.
+#
+# Instead of a fixed number of attacks, the singling out and linkability
+# attacks run in growing increments. After every increment the risk and its
+# confidence interval are updated, and the evaluation stops as soon as the
+# interval, before it is clipped to [0, 1], is narrower than the requested
+# tolerance.
+#
+# Increments never repeat work: linkability attacks disjoint slices of a
+# seeded shuffle of the targets and adds up the links, singling out keeps the
+# queries already found and evaluates only the new part of a seeded query
+# stream. A failed singling out round (e.g. too few queries to fit the control
+# size correction) simply continues with a larger budget.
+#
+# Multivariate queries come from the seeded bitmask search of multivariate.py,
+# whose cached bitmasks and pruned combinations make searching the earlier
+# part of the stream again cheap. One time budget covers all increments; once
+# it runs out, the risk is estimated from the queries found so far.
+
+import time
+
+import numpy as np
+import polars as pl
+from anonymeter.evaluators.singling_out_evaluator import (
+    _evaluate_queries,
+    _random_queries,
+    _safe_column_names,
+    fit_correction_term,
+    univariate_singling_out_queries,
+)
+from anonymeter.stats.confidence import EvaluationResults
+
+import encoding
+import engine
+import multivariate
+import profiling
+import results
+import stats
+
+START_ATTACKS = 100
+GROWTH = 2
+# A failing singling out evaluation may grow up to this multiple of `max_attacks`
+FAILURE_LIMIT = 4
+N_COLS = 3
+
+
+def _round_key(kind, frames, params, i):
+    return results.make_key(kind + "_round", frames, {**params, "round": i})
+
+
+def _publish(kind, frames, params, increments, increment):
+    # Every increment is cached on its own, so the app can show it while the job runs
+    results.put(_round_key(kind, frames, params, len(increments)), increment)
+    increments.append(increment)
+
+
+def _singling_out_params(tolerance, max_attacks=1000, mode='univariate', seed=0, time_budget=None):
+    params = {"tolerance": tolerance, "max_attacks": max_attacks, "mode": mode, "seed": seed, "width": "unclipped"}
+    if mode == 'multivariate':
+        params.update(search="bitmask", time_budget=time_budget)
+    return params
+
+
+def _linkability_params(tolerance, aux_cols, n_neighbors, max_attacks=4000, seed=0):
+    return {"tolerance": tolerance, "aux_cols": [list(cols) for cols in aux_cols], "n_neighbors": n_neighbors,
+            "max_attacks": max_attacks, "seed": seed, "index": "encoded-knn", "width": "unclipped"}
+
+
+_PARAMS = {"adaptive_singling_out": _singling_out_params, "adaptive_linkability": _linkability_params}
+
+
+def progress(kind, ori, syn, control, params):
+    """The increments of an adaptive evaluation that are already finished, without computing anything.
+
+    `params` are the arguments of the evaluation, e.g. of `singling_out` for "adaptive_singling_out".
+    """
+    params = _PARAMS[kind](**params)
+    out = []
+    while True:
+        increment = results.get(_round_key(kind, (ori, syn, control), params, len(out)))
+        if increment is None:
+            return out
+        out.append(increment)
+
+
+def _increment(res):
+    # The stop criterion is the width before clipping: a residual risk near 0 has a
+    # clipped CI that is much narrower than the uncertainty of the estimate
+    risk = res.risk()
+    return {"n_attacks": res.n_attacks_ori, "risk": risk.value, "ci": list(risk.ci), "width": stats.width(res)}
+
+
+def _budgets(max_attacks, limit):
+    # Doubling budgets up to `max_attacks`, then, if the caller asks for more, up to `limit`
+    n = min(START_ATTACKS, max_attacks)
+    while True:
+        yield n
+        n = min(n * GROWTH, max_attacks if n < max_attacks else limit)
+
+
+def _polars(df):
+    # Same preprocessing as anonymeter's SinglingOutEvaluator
+    return None if df is None else pl.DataFrame(_safe_column_names(df)).unique(maintain_order=True)
+
+
+def _n_singled_out(df, queries):
+    return sum(1 for count in _evaluate_queries(df=df, queries=queries) if count == 1)
+
+
+class _QueryStream:
+    # Singling out queries in a reproducible order: a longer prefix of the
+    # stream always extends a shorter one. Multivariate queries come from the
+    # seeded bitmask search, which stops at the deadline.
+    def __init__(self, syn, p_syn, mode, seed, deadline=None):
+        self._syn, self._p_syn, self._mode, self._seed = syn, p_syn, mode, seed
+        self._deadline = deadline
+        self.queries = []
+        self.exhausted = False
+        self.timed_out = False
+        self.search = None
+
+    def take(self, n):
+        if self._mode == "univariate" and not self.exhausted:
+            # Univariate queries are enumerated rather than sampled: get them all at once
+            self.queries = univariate_singling_out_queries(df=self._p_syn, n_queries=None,
+                                                           rng=np.random.default_rng(self._seed))
+            self.exhausted = True
+        if len(self.queries) < n and not self.exhausted:
+            # The search is seeded, so a longer search finds the same queries first
+            budget = None if self._deadline is None else max(0.0, self._deadline - time.monotonic())
+            found = multivariate.search(self._syn, n, n_cols=N_COLS, seed=self._seed, time_budget=budget,
+                                        n_workers=engine._n_workers())
+            self.queries = found["queries"]
+            self.search = {key: found[key] for key in ("candidates", "pruned", "elapsed", "complete")}
+            self.timed_out = not found["complete"] and budget is not None
+            self.exhausted = len(self.queries) < n
+        return self.queries[:n]
+
+
+def singling_out(ori, syn, control, tolerance, max_attacks=1000, mode='univariate', seed=0, time_budget=None):
+    """Singling out risk with a budget that doubles until the CI is narrower than `tolerance`.
+
+    If a round fails, the budget keeps growing up to FAILURE_LIMIT times
+    `max_attacks` before the error is raised. The multivariate query search
+    of all rounds together stops after `time_budget` seconds.
+    """
+    params = _singling_out_params(tolerance, max_attacks, mode, seed, time_budget)
+    frames = (ori, syn, control)
+
+    def compute():
+        p_ori, p_syn, p_control = _polars(ori), _polars(syn), _polars(control)
+        rng = np.random.default_rng(seed)
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        stream = _QueryStream(syn, p_syn, mode, int(rng.integers(2 ** 32)), deadline)
+        baseline_rng = np.random.default_rng(rng.integers(2 ** 32))
+        n_cols = 1 if mode == "univariate" else N_COLS
+
+        increments = []
+        last = None
+        n_done = n_evaluated = n_success = n_baseline = n_control = 0
+        for n in _budgets(max_attacks, FAILURE_LIMIT * max_attacks):
+            with profiling.stage("singling_out_queries", rows=n, mode=mode):
+                queries = stream.take(n)
+            if stream.timed_out:
+                # Time budget reached: estimate from the queries found so far
+                n = len(queries)
+                if n <= n_done:
+                    if last is None:
+                        raise RuntimeError("No multivariate singling out query was found within the time budget")
+                    return last
+            new = queries[n_evaluated:]
+            n_success += _n_singled_out(p_ori, new)
+            if p_control is not None:
+                n_control += _n_singled_out(p_control, new)
+            n_evaluated = len(queries)
+            n_baseline += _n_singled_out(p_ori, _random_queries(df=p_syn, n_queries=n - n_done,
+                                                                n_cols=n_cols, rng=baseline_rng))
+            n_done = n
+            try:
+                corrected = None if p_control is None else n_control
+                if p_control is not None and len(p_control) != len(p_ori):
+                    model = fit_correction_term(df=p_control, queries=queries)
+                    correction = model(len(p_ori)) / model(len(p_control))
+                    if not np.isfinite(correction):
+                        raise RuntimeError("Too few singling out queries to correct for the size of the control data")
+                    corrected = n_control * correction
+                res = EvaluationResults(n_attacks=n, n_success=n_success, n_baseline=n_baseline, n_control=corrected)
+                increment = _increment(res)
+            except RuntimeError as ex:
+                _publish("adaptive_singling_out", frames, params, increments, {"n_attacks": n, "error": str(ex)})
+                # More attacks keep the queries found so far, unless there are no new ones to find
+                if n >= FAILURE_LIMIT * max_attacks or len(queries) < n or stream.timed_out:
+                    raise
+                continue
+            _publish("adaptive_singling_out", frames, params, increments, increment)
+            last = {"results": res, "queries": [str(q) for q in queries], "increments": increments}
+            if stream.search is not None:
+                last["search"] = stream.search
+            # Once the query stream is used up more attacks would only add baseline guesses
+            if increment["width"] <= tolerance or n >= max_attacks or len(queries) < n or stream.timed_out:
+                return last
+
+    return results.cached("adaptive_singling_out", frames, params, compute)
+
+
+def linkability(ori, syn, control, tolerance, aux_cols, n_neighbors, max_attacks=4000, seed=0):
+    """Linkability risk with a budget that doubles until the CI is narrower than `tolerance`."""
+    aux_cols = [list(cols) for cols in aux_cols]
+    params = _linkability_params(tolerance, aux_cols, n_neighbors, max_attacks, seed)
+    frames = (ori, syn, control)
+
+    def compute():
+        limit = min(max_attacks, len(ori), len(ori) if control is None else len(control))
+        enc = encoding.encode(ori, syn, control)
+        rng = np.random.default_rng(seed)
+        ori_order = rng.permutation(len(ori))
+        control_order = None if control is None else len(ori) + rng.permutation(len(control))
+
+        increments = []
+        n_done = n_success = n_baseline = 0
+        n_control = None if control is None else 0
+        for n in _budgets(limit, limit):
+            # Every increment attacks targets that weren't attacked before
+            n_success += engine.count_links(enc, ori_order[n_done:n], aux_cols, n_neighbors)
+            if control is not None:
+                n_control += engine.count_links(enc, control_order[n_done:n], aux_cols, n_neighbors)
+            n_baseline += engine.random_links(rng, len(syn), n - n_done, n_neighbors)
+            n_done = n
+            res = EvaluationResults(n_attacks=n, n_success=n_success, n_baseline=n_baseline, n_control=n_control)
+            increment = _increment(res)
+            _publish("adaptive_linkability", frames, params, increments, increment)
+            if increment["width"] <= tolerance or n >= limit:
+                return {"results": res, "increments": increments}
+
+    return results.cached("adaptive_linkability", frames, params, compute)
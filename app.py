@@ -1,17 +1,22 @@
 # Import Streamlit UI Libraries
 import streamlit as st
 from streamlit_extras.colored_header import colored_header
-from streamlit_extras.dataframe_explorer import dataframe_explorer as dfe
-from streamlit_extras.stateful_button import button
 
 # Import python packages
+import io
 import os
+import uuid
 import pandas as pd
-import matplotlib.pyplot as plt
 
-from anonymeter.evaluators import SinglingOutEvaluator
-from anonymeter.evaluators import LinkabilityEvaluator
-from anonymeter.evaluators import InferenceEvaluator
+# The evaluators (adaptive, engine, stats), matplotlib and the dataframe
+# explorer are imported where they are used: the first page only needs the
+# datasets, so it renders before any of them is loaded
+import datasets
+import jobs
+import profiling
+import scenarios
+
+profiling.serve_metrics()
 
 def headers(label_str,desc_str):
     colored_header(
@@ -19,108 +24,249 @@ def headers(label_str,desc_str):
         description=desc_str,
         color_name="light-blue-70")
 
-def analyze_all(ori,
-                syn,
-                control,
-                num_sout_attacks,
-                num_link_attacks,
-                num_neighbors_linkability, 
-                auxiliary_columns1, 
-                auxiliary_columns2
-                ):
+def user_id():
+    # Behind an authenticating proxy the user is in the headers, otherwise every session counts as a user
+    if 'user_id' not in st.session_state:
+        headers = st.context.headers
+        st.session_state['user_id'] = headers.get("X-Forwarded-User") or headers.get("X-Forwarded-Email") or uuid.uuid4().hex
+    return st.session_state['user_id']
+
+def remember_jobs(name, submitted, submit):
+    # Job IDs are kept in the session and in the URL, so a rerun or a
+    # reconnect picks up the running or finished jobs again
+    if submitted:
+        try:
+            st.session_state[name] = submit()
+        except jobs.QueueFull as ex:
+            st.error(str(ex))
+            return None
+        st.query_params[name] = ",".join(st.session_state[name])
+    elif name not in st.session_state and name in st.query_params:
+        job_ids = st.query_params[name].split(",")
+        if all(jobs.status(job_id) != "unknown" for job_id in job_ids):
+            st.session_state[name] = job_ids
+    return st.session_state.get(name)
+
+def wait_job(job_id, status, label, on_poll=None):
+    def on_update(state):
+        status.update(label = label + " (" + state + ")", state='running', expanded=False)
+        if on_poll is not None:
+            on_poll()
+    record = jobs.wait(job_id, on_update)
+    if record is None:
+        status.update(label = label + " (no longer known to the server, please re-run the analysis)", state='error', expanded=False)
+    if isinstance(record, dict) and "rounds" in record:
+        # Fast estimate: say how many attacks it took and how wide its CI is
+        last = record["rounds"][-1]
+        note = (f"Fast estimate from {last['n_attacks']:,} of {record['n_full']:,} attacks, CI width {100 * last['width']:.1f} %. "
+                f"Projected CI with all attacks: {100 * record['projected_ci'][0]:.1f} - {100 * record['projected_ci'][1]:.1f} %.")
+        if record["full_ci"] is not None:
+            note += (f" Full run: risk {100 * record['full_risk']:.1f} %, CI {100 * record['full_ci'][0]:.1f} - "
+                     f"{100 * record['full_ci'][1]:.1f} %, estimate off by {100 * record['bias']:+.1f} %.")
+        status.caption(note)
+        record = record["record"]
+    if isinstance(record, dict) and record.get("search") and not record["search"]["complete"]:
+        status.caption(f"Time budget reached after {record['search']['elapsed']:.0f} s: "
+                       f"estimate from the {len(record['queries'])} queries found so far.")
+    if isinstance(record, dict) and "increments" in record:
+        last = record["increments"][-1]
+        status.caption(f"Adaptive budget: stopped after {last['n_attacks']:,} attacks in {len(record['increments'])} increments, "
+                       f"CI width {100 * last['width']:.1f} %.")
+    return record
+
+def eval_request(kind, params):
+    # In adaptive mode the attack slider sets the largest budget instead of a fixed one
+    if st.session_state['adaptive_mode'] and kind in ("singling_out", "linkability"):
+        params = dict(params)
+        params["max_attacks"] = params.pop("n_attacks")
+        params["tolerance"] = st.session_state['tolerance'] / 100
+        return "adaptive." + kind, params
+    return kind, params
+
+def increments_poll(kind, params, frames, status, label):
+    # Show the running estimate of an adaptive evaluation after every increment
+    def on_poll():
+        request, request_params = eval_request(kind, params)
+        if request.startswith("adaptive.") and not st.session_state['fast_mode']:
+            import adaptive
+            done = adaptive.progress("adaptive_" + kind, *frames, request_params)
+            if done and "width" in done[-1]:
+                last = done[-1]
+                status.update(label = label + f" ({last['n_attacks']} attacks, risk {100 * last['risk']:.1f} %, CI width {100 * last['width']:.1f} %)")
+    return on_poll
+
+def submit_eval(kind, frames, params):
+    kind, params = eval_request(kind, params)
+    # In fast mode the evaluation runs only as many attacks as the target CI width needs
+    if st.session_state['fast_mode']:
+        return jobs.submit("sampling.fast_estimate", frames, {"kind": kind,
+                                                              "params": params,
+                                                              "target_width": st.session_state['target_width'] / 100},
+                           profile=st.session_state['profile_jobs'], user=user_id())
+    return jobs.submit(kind, frames, params, profile=st.session_state['profile_jobs'], user=user_id())
+
+def stages_table(stages):
+    table = pd.DataFrame(stages).drop(columns=['pid'], errors='ignore')
+    st.dataframe(table.round({'wall': 3, 'cpu': 3, 'peak_rss_mb': 1, 'rss_increase_mb': 1}), hide_index=True)
+
+def performance(load_stages):
+    # Wall time, CPU time and peak RSS of every stage of this session's evaluations
+    st.markdown("**Loading the datasets**")
+    if load_stages:
+        stages_table(load_stages)
+    else:
+        st.caption("Served from the dataset cache.")
+    for name, label in [('all_jobs', "Analyze All"), ('sout_jobs', "Singling Out"), ('link_jobs', "Linkability"),
+                        ('infer_jobs', "Inference"), ('scenario_jobs', "Scenarios")]:
+        for job_id in st.session_state.get(name) or []:
+            st.markdown(f"**{label}** `{job_id[:12]}`")
+            stages = jobs.stages(job_id)
+            if stages:
+                stages_table(stages)
+            else:
+                st.caption("Not run by this server process (e.g. served from the results cache), no timings.")
+            if os.path.exists(jobs.profile_path(job_id)):
+                st.caption(f"cProfile statistics: `{jobs.profile_path(job_id)}`")
+
+def preview_table(df):
+    from streamlit_extras.dataframe_explorer import dataframe_explorer as dfe
+    # Only a sample is sent to the browser, large datasets would not fit
+    sample = datasets.preview(df)
+    st.dataframe(dfe(sample))
+    if len(sample) < len(df):
+        st.caption(f"Showing a sample of {len(sample):,} out of {len(df):,} rows.")
+
+def lazy_preview(label, key, desc, df):
+    # The explorer widgets are only built while the expander is open
+    with st.expander(label, key=key, on_change="rerun") as preview:
+        if preview.open:
+            headers(label, desc)
+            preview_table(df)
+
+def png(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight", dpi=150)
+    return buf.getvalue()
+
+def inference_risks(results):
+    import stats
+    return tuple(res[0] for res in results), tuple(stats.risk(res[1], confidence()).value for res in results)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def inference_chart(columns, risks):
+    # Drawn once per set of risks and served as an image on every rerun after that.
+    # A bare Figure, not pyplot: no global state shared by the sessions' threads
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+
+    ax.bar(x=range(len(columns)), height=risks, alpha=0.5, color='blue', ecolor='black', capsize=10)
+
+    ax.set_xticks(range(len(columns)), columns, rotation=45, ha='right')
+    ax.set_ylabel("Measured Inference Risk")
+    _ = ax.set_xlabel("Secret Column")
+    ax.xaxis.label.set_color('black')
+    ax.yaxis.label.set_color('black')
+    return png(fig)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def risk_heatmap(matrix):
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(max(4, 0.6 * len(matrix.columns) + 3), max(3, 0.35 * len(matrix) + 1)))
+    ax = fig.subplots()
+    image = ax.imshow(matrix.to_numpy(dtype=float), cmap='Reds', vmin=0, vmax=max(0.01, matrix.max().max()), aspect='auto')
+    ax.set_xticks(range(len(matrix.columns)), matrix.columns, rotation=45, ha='right')
+    ax.set_yticks(range(len(matrix)), matrix.index)
+    ax.set_xlabel("Secret Column")
+    ax.set_ylabel("Auxiliary Columns")
+    fig.colorbar(image, ax=ax, label="Measured Risk")
+    return png(fig)
+
+def confidence():
+    return st.session_state['confidence_level'] / 100
+
+def risk_scores(res, evaluation):
+    # Recomputed from the stored attack counts, so changing the confidence level is instant.
+    # The naive baseline attack is recomputed the same way, to compare the attack with
+    import stats
+    risk = stats.risk(res, confidence())
+    baseline = stats.risk(res, confidence(), baseline=True)
+    profiling.log_event("risk", evaluation=evaluation, value=risk.value, ci=list(risk.ci),
+                        baseline=baseline.value, baseline_ci=list(baseline.ci), confidence_level=confidence())
+    return {**stats.scores(risk), "risk": risk.value, "baseline": baseline.value, "baseline_ci": baseline.ci}
+
+def baseline_note(scores):
+    return (f"Attack risk {100 * scores['risk']:.2f} % vs. {100 * scores['baseline']:.2f} % for the naive baseline "
+            f"(CI {100 * scores['baseline_ci'][0]:.2f} - {100 * scores['baseline_ci'][1]:.2f} %)")
+
+def ci_note(res):
+    import stats
+    low, high = stats.bootstrap(res, confidence_level=confidence())["ci"]
+    return (f"The risk estimate is accompanied by a confidence interval (at {st.session_state['confidence_level']:g}% level) which accounts for the finite number of attacks specified with the slider. "
+            f"Bootstrapping the attack outcomes gives scores between {100 * (1 - high):.2f} % and {100 * (1 - low):.2f} %.")
+
+def sout_request(num_sout_attacks):
+    params = {"n_attacks": num_sout_attacks, "mode": st.session_state['sout_mode']}
+    if st.session_state['sout_mode'] == 'multivariate':
+        params["time_budget"] = st.session_state['sout_time_budget']
+    return params
+
+def submit_all(ori,
+               syn,
+               control,
+               num_sout_attacks,
+               num_link_attacks,
+               num_neighbors_linkability, 
+               auxiliary_columns1, 
+               auxiliary_columns2
+               ):
+    frames = (ori, syn, control)
+    return [
+        submit_eval("singling_out", frames, sout_request(num_sout_attacks)),
+        submit_eval("linkability", frames, {"n_attacks": num_link_attacks,
+                                            "aux_cols": [auxiliary_columns1, auxiliary_columns2],
+                                            "n_neighbors": num_neighbors_linkability}),
+        submit_eval("inference_all", frames, {}),
+    ]
+
+def analyze_all(sout_job, link_job, infer_job):
+    # The scores stay None if their job failed or is no longer known
     # Singling Out
-    status.update(label = "Measuring Singling Out Risk...", state='running',expanded=False)
-    evaluator = SinglingOutEvaluator(ori=ori, 
-                                     syn=syn, 
-                                     control=control,
-                                     n_attacks=num_sout_attacks)
-    
+    sscores = None
     try:
-        evaluator.evaluate(mode='univariate')
-        srisk = evaluator.risk()
-        print(srisk)
-        srisk_val = srisk.value 
-        ci_from = srisk.ci[0] 
-        ci_to = srisk.ci[1]
-        
-        srisk_score = 100 - 100 * srisk_val
-        sci_from = 100 * (1-ci_from)
-        sci_to = 100 * (1-ci_to)
-        st.session_state['srisk_score'] = srisk_score
-        st.session_state['sci_from'] = sci_from
-        st.session_state['sci_to'] = sci_to
+        sout = wait_job(sout_job, status, "Measuring Singling Out Risk...")
+        if sout is not None:
+            sscores = risk_scores(sout["results"], "singling_out")
+            srisk_score, sci_from, sci_to = sscores["score"], sscores["ci_from"], sscores["ci_to"]
+            st.session_state['srisk_score'] = srisk_score
+            st.session_state['sci_from'] = sci_from
+            st.session_state['sci_to'] = sci_to
+            status.update(label = ":dna: Singling Out: "+str(round(srisk_score,2)), state='running',expanded=False)
     except RuntimeError as ex: 
         st.write(f"Singling out evaluation failed with {ex}. Please re-run this cell."
               "For more stable results increase `n_attacks`. Note that this will "
               "make the evaluation slower.")
-    status.update(label = ":dna: Singling Out: "+str(round(srisk_score,2)), state='running',expanded=False)
     # Linkability
-    status.update(label = "Measuring Linkability Risk...", state='running',expanded=False)   
-    aux_cols = [
-        ['type_employer', 'education', 'hr_per_week', 'capital_loss', 'capital_gain'],
-        [ 'race', 'sex', 'fnlwgt', 'age', 'country']
-    ]
-    
-    evaluator = LinkabilityEvaluator(ori=ori, 
-                                     syn=syn, 
-                                     control=control,
-                                     n_attacks=num_link_attacks,
-                                     aux_cols=aux_cols,
-                                     n_neighbors=num_neighbors_linkability)
-    
-    evaluator.evaluate(n_jobs=-2)  # n_jobs follow joblib convention. -1 = all cores, -2 = all execept one
-    lrisk = evaluator.risk()
-    print(lrisk)
-    lrisk_val = lrisk.value 
-    ci_from = lrisk.ci[0] 
-    ci_to = lrisk.ci[1]
-    
-    lrisk_score = 100 - 100 * lrisk_val
-    lci_from = 100 * (1-ci_from)
-    lci_to = 100 * (1-ci_to)
-    status.update(label = ":link: Linkability: "+str(round(lrisk_score,2)), state='running',expanded=False)
+    lscores = None
+    link = wait_job(link_job, status, "Measuring Linkability Risk...")
+    if link is not None:
+        lscores = risk_scores(link["results"], "linkability")
+        status.update(label = ":link: Linkability: "+str(round(lscores["score"],2)), state='running',expanded=False)
     
     # Inference
-    status.update(label = "Measuring Inference Risk...", state='running',expanded=False) 
-    
-    # If user has changed the dataset targets or updated the session state
-    # use the selected columns for aux_cols
-    if st.session_state['auxiliary_columns1'] is not None and st.session_state['auxiliary_columns2'] is not None:
-        aux_cols = [
-            st.session_state['auxiliary_columns1'],
-            st.session_state['auxiliary_columns2']
-        ]
+    iscores = None
+    results = wait_job(infer_job, status, "Measuring Inference Risk...")
+    if results is not None:
+        iscores = risk_scores(results[-1][1], "inference")
+        status.update(label = ":crystal_ball: Inference: "+str(round(iscores["score"],2)), state='running',expanded=False)
+    return sscores, lscores, iscores
+
+def score_metric(container, label, scores):
+    if scores is None:
+        container.metric(label, "n/a")
     else:
-        aux_cols = [
-            ['type_employer', 'education', 'hr_per_week', 'capital_loss', 'capital_gain'],
-            [ 'race', 'sex', 'fnlwgt', 'age', 'country']
-        ]
-    columns = ori.columns
-    results = []
-    
-    for secret in columns:
-        
-        aux_cols = [col for col in columns if col != secret]
-        
-        evaluator = InferenceEvaluator(ori=ori, 
-                                       syn=syn, 
-                                       control=control,
-                                       aux_cols=aux_cols,
-                                       secret=secret,
-                                       n_attacks=1000)
-        evaluator.evaluate(n_jobs=-2)
-        results.append((secret, evaluator.results()))
-    
-    irisk = evaluator.risk()
-    print(irisk)
-    irisk_val = irisk.value 
-    ci_from = irisk.ci[0] 
-    ci_to = irisk.ci[1]
-    irisk_score = 100 - 100 * irisk_val
-    ici_from = 100 * (1-ci_from)
-    ici_to = 100 * (1-ci_to)
-    status.update(label = ":crystal_ball: Inference: "+str(round(irisk_score,2)), state='running',expanded=False)
-    return srisk_score, sci_to, lrisk_score, lci_to, irisk_score, ici_to
+        container.metric(label, str(round(scores["score"],2))+' %', str(round(scores["ci_to"],2))+' %', delta_color="off")
+        container.caption(baseline_note(scores))
 
 
 # Session variable
@@ -130,6 +276,10 @@ if 'is_score_expanded' not in st.session_state:
     st.session_state['is_score_expanded'] = True
 if 'num_sout_attacks' not in st.session_state:
     st.session_state['num_sout_attacks'] = 500
+if 'sout_mode' not in st.session_state:
+    st.session_state['sout_mode'] = 'univariate'
+if 'sout_time_budget' not in st.session_state:
+    st.session_state['sout_time_budget'] = 60
 if 'num_link_attacks' not in st.session_state:
     st.session_state['num_link_attacks'] = 2000
 if 'num_neighbors_linkability' not in st.session_state:
@@ -138,6 +288,23 @@ if 'auxiliary_columns1' not in st.session_state:
     st.session_state['auxiliary_columns1'] = None
 if 'auxiliary_columns2' not in st.session_state:
     st.session_state['auxiliary_columns2'] = None
+if 'fast_mode' not in st.session_state:
+    st.session_state['fast_mode'] = False
+if 'target_width' not in st.session_state:
+    st.session_state['target_width'] = 5.0
+if 'adaptive_mode' not in st.session_state:
+    st.session_state['adaptive_mode'] = False
+if 'tolerance' not in st.session_state:
+    st.session_state['tolerance'] = 2.0
+if 'confidence_level' not in st.session_state:
+    st.session_state['confidence_level'] = 95.0
+if 'upload_digests' not in st.session_state:
+    # Content hash of every upload, by file_id: a rerun doesn't read the files again
+    st.session_state['upload_digests'] = {}
+if 'show_performance' not in st.session_state:
+    st.session_state['show_performance'] = False
+if 'profile_jobs' not in st.session_state:
+    st.session_state['profile_jobs'] = profiling.PROFILE
 
 st.set_page_config(
     page_title="Anonymeter",
@@ -149,13 +316,13 @@ st.set_page_config(
 st.title("**Analyze Synthetic Data Risk with Anonymeter**")
 
 header1, headera, header2 = st.columns([9,5,20])        
-bucket_url = "https://storage.googleapis.com/statice-public/anonymeter-datasets/"
 
 # Tabs!
-data, sout, link, infer, more = st.tabs([":bar_chart: Datasets", 
+data, sout, link, infer, scen, more = st.tabs([":bar_chart: Datasets", 
                                 ":dna: Singling Out",
                                 ":link: Linkability",
                                 ":crystal_ball: Inference",
+                                ":world_map: Scenarios",
                                 ":books: More Info"])
 with more:
     st.markdown(f"**_Anonymeter_** contains privacy evaluators to measure the risks of singling out, linkability, and inference attacks that may be carried out against a synthetic dataset."
@@ -168,43 +335,59 @@ with header1:
         # Every form must have a submit button.
         submitted = st.form_submit_button(":rocket: Analyze All")
 
+with headera:
+    st.toggle("Fast estimate", key='fast_mode',
+              help="Run only as many attacks as needed for the target confidence interval width")
+    st.number_input("Target CI width (%)", min_value=0.5, max_value=50.0, step=0.5, key='target_width',
+                    disabled=not st.session_state['fast_mode'])
+    st.toggle("Adaptive attacks", key='adaptive_mode',
+              help="Run singling out and linkability attacks in growing increments, up to the number set with the sliders, "
+                   "and stop once the confidence interval is narrow enough")
+    st.number_input("CI tolerance (%)", min_value=0.5, max_value=50.0, step=0.5, key='tolerance',
+                    disabled=not st.session_state['adaptive_mode'])
+    st.slider("Confidence level (%)", min_value=50.0, max_value=99.9, step=0.5, key='confidence_level',
+              help="Confidence level of the intervals, recomputed from the stored attack results without re-running them")
+    st.toggle("Show performance", key='show_performance',
+              help="Show the wall time, CPU time and memory of every stage of the evaluations below the results")
+    st.toggle("Profile runs", key='profile_jobs',
+              help="Run the next evaluations under cProfile and save the statistics under the cache directory")
+
 with data:
 
     # Checkbox to use custom data
     use_own_data = st.toggle("Use my own data")
 
-    if use_own_data:
-        st.write("Upload your original, synthetic, and control datasets:")
-        ori_file = st.file_uploader("Upload Original Data (CSV)", type="csv", key="ori")
-        syn_file = st.file_uploader("Upload Synthetic Data (CSV)", type="csv", key="syn")
-        control_file = st.file_uploader("Upload Control Data (CSV)", type="csv", key="control")
+    # Timings of the downloads and CSV parsing for the performance expander
+    with profiling.collect() as load_stages:
+        if use_own_data:
+            st.write("Upload your original, synthetic, and control datasets:")
+            ori_file = st.file_uploader("Upload Original Data (CSV)", type="csv", key="ori")
+            syn_file = st.file_uploader("Upload Synthetic Data (CSV)", type="csv", key="syn")
+            control_file = st.file_uploader("Upload Control Data (CSV)", type="csv", key="control")
 
-        if ori_file and syn_file and control_file:
-            ori = pd.read_csv(ori_file)
-            syn = pd.read_csv(syn_file)
-            control = pd.read_csv(control_file)
+            if ori_file and syn_file and control_file:
+                ori = datasets.load_upload(ori_file, st.session_state['upload_digests'])
+                syn = datasets.load_upload(syn_file, st.session_state['upload_digests'])
+                control = datasets.load_upload(control_file, st.session_state['upload_digests'])
+            else:
+                st.warning("Please upload all three datasets to proceed.")
+                st.stop()
         else:
-            st.warning("Please upload all three datasets to proceed.")
-            st.stop()
-    else:
-        ori = pd.read_csv(os.path.join(bucket_url, "adults_train.csv"))
-        syn = pd.read_csv(os.path.join(bucket_url, "adults_syn_ctgan.csv"))
-        control = pd.read_csv(os.path.join(bucket_url, "adults_control.csv"))
+            ori = datasets.load_default("adults_train.csv")
+            syn = datasets.load_default("adults_syn_ctgan.csv")
+            control = datasets.load_default("adults_control.csv")
     
     
     dcol1, dcol2, dcol3 = st.columns(3)
     with dcol1:
-        with st.expander("Original Dataset"):
-            headers("Original Dataset",f"Training data is the original dataset, which is used to train the generative model.")
-            st.dataframe(dfe(ori))
+        lazy_preview("Original Dataset", "preview_ori",
+                     "Training data is the original dataset, which is used to train the generative model.", ori)
     with dcol2:
-        with st.expander("Synthetic Dataset"):
-            headers("Synthetic Dataset",f"Generated data is the synthetic dataset, which is generated by the generative model.")
-            st.dataframe(dfe(syn))
+        lazy_preview("Synthetic Dataset", "preview_syn",
+                     "Generated data is the synthetic dataset, which is generated by the generative model.", syn)
     with dcol3:
-        with st.expander("Control Dataset"):
-            headers("Control Dataset",f"Lastly, the control dataset acts as a holdout group to validate the results.")
-            st.dataframe(dfe(control))
+        lazy_preview("Control Dataset", "preview_control",
+                     "Lastly, the control dataset acts as a holdout group to validate the results.", control)
 
 with sout:
     st.markdown(f"## Measuring the Singling Out Risk\n\n"
@@ -214,7 +397,8 @@ with sout:
     st.divider()
     
     scol1, scol2 = st.columns(2)
-    scol1.markdown("### Assess\n\nIn this example, we evaluate the susceptibility of the synthetic data to `univariate` singling out attacks, which try to find unique values of some attribute to single out an individual.\n\n")
+    scol1.markdown("### Assess\n\nIn this example, we evaluate the susceptibility of the synthetic data to singling out attacks. `univariate` attacks try to find unique values of some attribute to single out an individual, "
+                   "`multivariate` attacks look for unique combinations of the values of several attributes.\n\n")
     scol1.divider()
     with scol1.form("Singling Out Settings"):
         num_sout_attacks = st.slider(
@@ -225,30 +409,32 @@ with sout:
                 step=100,
                 help="Use this to enter the number of Singling Out attacks")
         st.session_state['num_sout_attacks'] = num_sout_attacks
+        st.radio("**Singling Out Mode**", ['univariate', 'multivariate'], key='sout_mode', horizontal=True)
+        st.number_input("**Time Budget (seconds)**", min_value=5, max_value=3600, step=5, key='sout_time_budget',
+                        help="Multivariate only: stop searching for queries after this long and estimate the risk from the queries found so far")
         sout_submitted = st.form_submit_button(":dna: Analyze Singling Out Risk")
-    if sout_submitted:
+    sout_params = sout_request(num_sout_attacks)
+    sout_jobs = remember_jobs('sout_jobs', sout_submitted, lambda: [
+        submit_eval("singling_out", (ori, syn, control), sout_params)
+    ])
+    if sout_jobs:
         
         with scol2.status("Measuring Singling Out Risk...", expanded=False) as status:
-            evaluator = SinglingOutEvaluator(ori=ori, 
-                                             syn=syn, 
-                                             control=control,
-                                             n_attacks=num_sout_attacks)
-            
+            sout_queries = []
+            srisk_score = None
             try:
-                evaluator.evaluate(mode='univariate')
-                srisk = evaluator.risk()
-                print(srisk)
-                srisk_val = srisk.value 
-                ci_from = srisk.ci[0] 
-                ci_to = srisk.ci[1]
-    
-                srisk_score = 100 - 100 * srisk_val
-                sci_from = 100 * (1-ci_from)
-                sci_to = 100 * (1-ci_to)
+                sout = wait_job(sout_jobs[0], status, "Measuring Singling Out Risk...",
+                                increments_poll("singling_out", sout_params, (ori, syn, control), status, "Measuring Singling Out Risk..."))
+                if sout is not None:
+                    sout_queries = sout["queries"]
+                    sscores = risk_scores(sout["results"], "singling_out")
+                    srisk_score, sci_from, sci_to = sscores["score"], sscores["ci_from"], sscores["ci_to"]
     
-                st.metric("Singling Out Score", str(round(srisk_score,2))+' %', str(round(sci_to,2))+' %', delta_color="off")
-                header2.metric("Singling Out Score", str(round(srisk_score,2))+' %', str(round(sci_to,2))+' %', delta_color="off")
-                st.markdown(f"The risk estimate is accompanied by a confidence interval (at 95% level by default) which accounts for the finite number of attacks specified with the slider.")
+                    st.metric("Singling Out Score", str(round(srisk_score,2))+' %', str(round(sci_to,2))+' %', delta_color="off")
+                    st.caption(baseline_note(sscores))
+                    header2.metric("Singling Out Score", str(round(srisk_score,2))+' %', str(round(sci_to,2))+' %', delta_color="off")
+                    header2.caption(baseline_note(sscores))
+                    st.markdown(ci_note(sout["results"]))
             
             except RuntimeError as ex: 
                 header2.error(f"Singling out evaluation failed with {ex}. Please re-run the analysis."
@@ -260,7 +446,7 @@ with sout:
             
             n_queries = 3
     
-            sout_attacks = evaluator.queries()[:n_queries]
+            sout_attacks = sout_queries[:n_queries]
     
             headers(":crossed_swords: Attacks",
                 f"Using the `queries()` method, we can see what kind of singling out queries (i.e. the *guesses*) the attacker has come up with."
@@ -269,7 +455,7 @@ with sout:
                 )
             
             q = 0
-            while q < n_queries:
+            while q < len(sout_attacks):
                 st.write(sout_attacks[q])
                 q=q+1
 
@@ -326,38 +512,29 @@ with link:
         st.session_state['auxiliary_columns2'] = auxiliary_columns2
 
         link_submitted = st.form_submit_button(":link: Analyze Linkablity Risk")
-    if link_submitted:
+    link_params = {"n_attacks": num_link_attacks,
+                   "aux_cols": [auxiliary_columns1, auxiliary_columns2],
+                   "n_neighbors": num_neighbors_linkability}
+    link_jobs = remember_jobs('link_jobs', link_submitted, lambda: [
+        submit_eval("linkability", (ori, syn, control), link_params)
+    ])
+    if link_jobs:
         with lcol2.status("Measuring Linkability Risk...", expanded=False) as status:
-            aux_cols = [
-                auxiliary_columns1,
-                auxiliary_columns2
-            ]
-            
-            evaluator = LinkabilityEvaluator(ori=ori, 
-                                             syn=syn, 
-                                             control=control,
-                                             n_attacks=num_link_attacks,
-                                             aux_cols=aux_cols,
-                                             n_neighbors=num_neighbors_linkability)
-            
-            evaluator.evaluate(n_jobs=-2)  # n_jobs follow joblib convention. -1 = all cores, -2 = all execept one
-            lrisk = evaluator.risk()
-    
-            print(lrisk)
-            lrisk_val = lrisk.value 
-            ci_from = lrisk.ci[0] 
-            ci_to = lrisk.ci[1]
+            link_record = wait_job(link_jobs[0], status, "Measuring Linkability Risk...",
+                                   increments_poll("linkability", link_params, (ori, syn, control), status, "Measuring Linkability Risk..."))
+            if link_record is not None:
+                lres = link_record["results"]
+                lscores = risk_scores(lres, "linkability")
+                lrisk_score, lci_from, lci_to = lscores["score"], lscores["ci_from"], lscores["ci_to"]
             
-            lrisk_score = 100 - 100 * lrisk_val
-            lci_from = 100 * (1-ci_from)
-            lci_to = 100 * (1-ci_to)
+                st.metric(":link: Linkability", str(round(lrisk_score,2))+' %', str(round(lci_to))+' %', delta_color="off")
+                st.caption(baseline_note(lscores))
+                header2.metric(":link: Linkability", str(round(lrisk_score,2))+' %', str(round(lci_to))+' %', delta_color="off")
+                header2.caption(baseline_note(lscores))
+                st.markdown(ci_note(lres))
             
-            st.metric(":link: Linkability", str(round(lrisk_score,2))+' %', str(round(lci_to))+' %', delta_color="off")
-            header2.metric(":link: Linkability", str(round(lrisk_score,2))+' %', str(round(lci_to))+' %', delta_color="off")
-            st.markdown(f"The risk estimate is accompanied by a confidence interval (at 95% level by default) which accounts for the finite number of attacks specified with the slider.")
-            
-            if lrisk_score and lci_from and lci_to:
-                    status.update(label = ":link: Linkability: "+str(round(lrisk_score,2)), state='complete',expanded=False)
+                if lrisk_score and lci_from and lci_to:
+                        status.update(label = ":link: Linkability: "+str(round(lrisk_score,2)), state='complete',expanded=False)
 with infer:
     st.markdown(f"## Measuring the Inference Risk\n\n"
                 "Finally, `Anonymeter` allows to measure the inference risk. It does so by measuring the success of an attacker that tries to discover the value of some secret attribute for a set of target records on which some auxiliary knowledge is available.\n\n"
@@ -370,75 +547,96 @@ with infer:
     icol1.divider()
     with icol1.form("Inference Settings"):
         infer_submitted = st.form_submit_button(":crystal_ball: Analyze Inference Risk")
-    if infer_submitted:
+    infer_jobs = remember_jobs('infer_jobs', infer_submitted, lambda: [
+        submit_eval("inference_all", (ori, syn, control), {})
+    ])
+    if infer_jobs:
         with icol2.status("Measuring Inference Risk...", expanded=False) as status:
-            
-            aux_cols = [
-                auxiliary_columns1,
-                auxiliary_columns2
-            ]
-            columns = ori.columns
-            results = []
-            
-            for secret in columns:
-                
-                aux_cols = [col for col in columns if col != secret]
-                
-                evaluator = InferenceEvaluator(ori=ori, 
-                                               syn=syn, 
-                                               control=control,
-                                               aux_cols=aux_cols,
-                                               secret=secret,
-                                               n_attacks=1000)
-                evaluator.evaluate(n_jobs=-2)
-                results.append((secret, evaluator.results()))
-            
-            irisk = evaluator.risk()
-            print(irisk)
-            irisk_val = irisk.value 
-            ci_from = irisk.ci[0] 
-            ci_to = irisk.ci[1]
-            
-            irisk_score = 100 - 100 * irisk_val
-            ici_from = 100 * (1-ci_from)
-            ici_to = 100 * (1-ci_to)
-            
-            st.metric(":crystal_ball: Inference", str(round(irisk_score,2))+' %', str(round(ici_to))+' %', delta_color="off")
-            header2.metric(":crystal_ball: Inference", str(round(irisk_score,2))+' %', str(round(ici_to))+' %', delta_color="off")
-            st.markdown(f"The risk estimate is accompanied by a confidence interval (at 95% level by default) which accounts for the finite number of attacks specified with the slider.")
+            summary = st.container()
+            chart = st.empty()
+            drawn = []
 
-            fig, ax = plt.subplots()
-            
-            risks = [res[1].risk().value for res in results]
-            columns = [res[0] for res in results]
+            # Draw the columns that are already finished while the sweep is running
+            def draw_progress():
+                import engine
+                partial = engine.inference_progress(ori, syn, control)
+                if len(partial) != len(drawn):
+                    drawn[:] = partial
+                    chart.image(inference_chart(*inference_risks(partial)))
+                    status.update(label = "Measuring Inference Risk... (" + str(len(partial)) + "/" + str(len(ori.columns)) + " columns)")
+
+            results = wait_job(infer_jobs[0], status, "Measuring Inference Risk...", draw_progress)
+            if results is not None:
+                iscores = risk_scores(results[-1][1], "inference")
+                irisk_score, ici_from, ici_to = iscores["score"], iscores["ci_from"], iscores["ci_to"]
             
-            ax.bar(x=columns, height=risks, alpha=0.5, color='blue', ecolor='black', capsize=10)
-        
-            plt.xticks(rotation=45, ha='right')
-            ax.set_ylabel("Measured Inference Risk")
-            _ = ax.set_xlabel("Secret Column")
-            ax.xaxis.label.set_color('black')
-            ax.yaxis.label.set_color('black')
-    
-            st.pyplot(fig)
+                summary.metric(":crystal_ball: Inference", str(round(irisk_score,2))+' %', str(round(ici_to))+' %', delta_color="off")
+                summary.caption(baseline_note(iscores))
+                header2.metric(":crystal_ball: Inference", str(round(irisk_score,2))+' %', str(round(ici_to))+' %', delta_color="off")
+                header2.caption(baseline_note(iscores))
+                summary.markdown(ci_note(results[-1][1]))
 
-            if irisk_score and ici_from and ici_to:
-                status.update(label = ":crystal_ball: Inference Risk: "+str(round(irisk_score,2)), state='complete',expanded=True)
+                chart.image(inference_chart(*inference_risks(results)))
+
+                if irisk_score and ici_from and ici_to:
+                    status.update(label = ":crystal_ball: Inference Risk: "+str(round(irisk_score,2)), state='complete',expanded=True)
+with scen:
+    st.markdown(f"## Sweeping Attacker Knowledge Scenarios\n\n"
+                "The risks above are measured for a single choice of auxiliary columns. A scenario sweep repeats the linkability or inference attack for many of them, "
+                "e.g. every group of `k` columns or all columns but one, and shows the risk of every scenario in a heatmap.\n\n"
+                "The datasets are encoded once and the scenarios that share auxiliary columns share their nearest neighbour search.")
+    st.divider()
+    ccol1, ccol2 = st.columns(2)
+    with ccol1.form("Scenario Settings"):
+        scenario_kind = st.radio("**Attack**", ["linkability", "inference"], horizontal=True)
+        scenario_method = st.radio("**Scenarios**", ["k_subsets", "leave_one_out"], horizontal=True,
+                                   format_func=lambda m: {"k_subsets": "All groups of k columns",
+                                                          "leave_one_out": "Leave one column out"}[m],
+                                   help="For linkability, 'Leave one column out' starts from the groups selected on the Linkability tab")
+        scenario_k = st.number_input("**k**", min_value=1, max_value=max(1, len(ori.columns) - 1), value=1)
+        scenario_columns = st.multiselect("Columns known to the attacker", list(ori.columns), default=list(ori.columns))
+        scenario_limit = st.slider("**Maximum Number of Scenarios**", min_value=4, max_value=256,
+                                   value=scenarios.MAX_SCENARIOS, step=4)
+        scenario_submitted = st.form_submit_button(":world_map: Sweep Scenarios")
+    scenario_list = scenarios.generate(scenario_kind, scenario_columns, scenario_method, k=scenario_k,
+                                       split=[auxiliary_columns1, auxiliary_columns2], limit=scenario_limit)
+    scenario_params = {"n_link_attacks": num_link_attacks, "n_neighbors": num_neighbors_linkability}
+    scenario_jobs = remember_jobs('scenario_jobs', scenario_submitted, lambda: [
+        jobs.submit("scenarios.sweep_all", (ori, syn, control), {"scenarios": scenario_list, **scenario_params},
+                    profile=st.session_state['profile_jobs'], user=user_id())
+    ])
+    if scenario_jobs:
+        with ccol2.status("Sweeping Scenarios...", expanded=False) as status:
+            def sweep_progress():
+                done = scenarios.progress(ori, syn, control, scenario_list, **scenario_params)
+                status.update(label = "Sweeping Scenarios... (" + str(done) + "/" + str(len(scenario_list)) + " scenarios)")
+
+            sweep = wait_job(scenario_jobs[0], status, "Sweeping Scenarios...", sweep_progress)
+            if sweep is not None:
+                matrix = scenarios.risk_matrix(sweep, confidence())
+                st.image(risk_heatmap(matrix))
+                st.dataframe(matrix)
+                status.update(label = ":world_map: " + str(len(sweep["scenarios"])) + " scenarios", state='complete', expanded=True)
 with header2:
-    if submitted:
+    all_jobs = remember_jobs('all_jobs', submitted, lambda: submit_all(ori,
+                                                                       syn,
+                                                                       control,
+                                                                       num_sout_attacks,
+                                                                       num_link_attacks,
+                                                                       num_neighbors_linkability, 
+                                                                       auxiliary_columns1, 
+                                                                       auxiliary_columns2
+                                                                       ))
+    if all_jobs:
         with st.status("Measuring Holistic Risk Scores...", expanded=False) as status:
-            analyzed = analyze_all(ori,
-                                   syn,
-                                   control,
-                                   num_sout_attacks,
-                                   num_link_attacks,
-                                   num_neighbors_linkability, 
-                                   auxiliary_columns1, 
-                                   auxiliary_columns2
-                                )
+            analyzed = analyze_all(*all_jobs)
             col1, col2, col3 = st.columns(3)
             st.write("*Confidence indicator (CI) in grey")
-            col1.metric(":dna: Singling Out", str(round(analyzed[0],2))+' %', str(round(analyzed[1],2))+' %', delta_color="off")
-            col2.metric(":link: Linkability", str(round(analyzed[2],2))+' %', str(round(analyzed[3],2))+' %', delta_color="off")
-            col3.metric(":crystal_ball: Inference", str(round(analyzed[4],2))+' %', str(round(analyzed[5],2))+' %', delta_color="off")
-            status.update(label = "Analysis Complete", state='complete',expanded=True)
\ No newline at end of file
+            score_metric(col1, ":dna: Singling Out", analyzed[0])
+            score_metric(col2, ":link: Linkability", analyzed[1])
+            score_metric(col3, ":crystal_ball: Inference", analyzed[2])
+            status.update(label = "Analysis Complete", state='complete',expanded=True)
+
+if st.session_state['show_performance']:
+    with st.expander(":stopwatch: Performance", expanded=True):
+        performance(load_stages)
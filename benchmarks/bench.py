@@ -0,0 +1,310 @@
+# Benchmarks of the evaluation pipeline.
+#
+# Runs the same singling out / linkability / per-column inference sequence as
+# "Analyze All" (engine.analyze) on seeded synthetic tables of several sizes
+# and on the local adults files, and reports latency percentiles, throughput
+# and peak memory. Every run happens in a fresh subprocess with an empty cache
+# directory, so nothing is served from the dataset or results caches, and
+# nothing is downloaded.
+#
+# The "startup" case renders the first page of app.py (Streamlit's AppTest) in
+# a fresh process, with only the adults datasets in its cache, and fails when
+# the median time to first render exceeds --startup-target or when the first
+# page loads one of the STARTUP_DEFERRED modules.
+#
+#     python benchmarks/bench.py --rows 10000 100000 --cols 8 16 --repeat 3
+#     python benchmarks/bench.py --save-baseline       # after a known-good change
+#     python benchmarks/bench.py                       # exits with 1 on a regression
+#
+# Baselines are only comparable on the same machine.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+ADULTS = ["adults_train.csv", "adults_syn_ctgan.csv", "adults_control.csv"]
+PERCENTILES = [50, 90, 99]
+STARTUP_SECONDS = float(os.environ.get("SD_RISK_STARTUP_SECONDS", "2.0"))
+# Evaluators and plotting, which the first page must not wait for
+STARTUP_DEFERRED = ["anonymeter", "scipy", "matplotlib", "sklearn", "engine", "adaptive", "stats", "multivariate",
+                    "streamlit_extras.dataframe_explorer"]
+
+
+def make_table(n_rows, n_cols, seed):
+    """A seeded table with a mix of integer, float, low and high cardinality categorical columns."""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("abcdefgh"))
+    weights = 1 / np.arange(1, len(letters) + 1)
+    columns = {}
+    for j in range(n_cols):
+        kind = j % 4
+        if kind == 0:
+            columns[f"int_{j}"] = rng.integers(17, 90, n_rows)
+        elif kind == 1:
+            columns[f"float_{j}"] = rng.lognormal(10, 1, n_rows).round(2)
+        elif kind == 2:
+            columns[f"cat_{j}"] = pd.Categorical(rng.choice(letters, size=n_rows, p=weights / weights.sum()))
+        else:
+            columns[f"id_{j}"] = pd.Categorical(np.char.add("v", rng.integers(0, 1000, n_rows).astype(str)))
+    return pd.DataFrame(columns)
+
+
+def make_synthetic(ori, seed, noise=0.1):
+    # Resampled original records, with a share of every column replaced by random values
+    rng = np.random.default_rng(seed)
+    syn = ori.iloc[rng.integers(0, len(ori), len(ori))].reset_index(drop=True)
+    for col in syn.columns:
+        replace = rng.random(len(syn)) < noise
+        values = ori[col].to_numpy()[rng.integers(0, len(ori), replace.sum())]
+        column = syn[col].to_numpy(copy=True)
+        column[replace] = values
+        syn[col] = pd.Categorical(column, categories=ori[col].cat.categories) if isinstance(ori[col].dtype, pd.CategoricalDtype) else column
+    return syn
+
+
+def _frames(case):
+    if case["source"] == "adults":
+        return [pd.read_parquet(path) for path in case["paths"]]
+    ori = make_table(case["rows"], case["cols"], case["seed"])
+    control = make_table(case["rows"], case["cols"], case["seed"] + 1)
+    return [ori, make_synthetic(ori, case["seed"] + 2), control]
+
+
+def _child(case, params):
+    # One measured run, in a process of its own: prints a JSON line with the stages
+    import engine
+    import profiling
+
+    ori, syn, control = _frames(case)
+    columns = list(ori.columns)
+    aux_cols = case.get("aux_cols") or [columns[::2], columns[1::2]]
+    params = dict(params, n_link_attacks=min(params["n_link_attacks"], len(ori), len(control)))
+    start, cpu = time.perf_counter(), time.process_time()
+    with profiling.collect() as stages:
+        engine.analyze(ori, syn, control, aux_cols=aux_cols, **params)
+    print(json.dumps({
+        "wall": time.perf_counter() - start,
+        "cpu": time.process_time() - cpu,
+        "peak_rss_mb": profiling._process_peak_rss_mb(),
+        "rows": len(ori),
+        "cols": len(columns),
+        "stages": stages,
+    }))
+
+
+def _startup_child():
+    # Streamlit, numpy and pandas are already loaded in a running server, the clock covers the app's own first run
+    from streamlit.testing.v1 import AppTest
+
+    import profiling
+
+    app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=300)
+    start = time.perf_counter()
+    app.run()
+    print(json.dumps({
+        "wall": time.perf_counter() - start,
+        "peak_rss_mb": profiling._process_peak_rss_mb(),
+        "exceptions": [str(ex.value) for ex in app.exception],
+        "deferred_loaded": [name for name in STARTUP_DEFERRED if name in sys.modules],
+    }))
+
+
+def run_startup(paths, repeat):
+    """Time to first render of app.py in `repeat` fresh processes, each with a cache holding only the adults datasets."""
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache:
+            os.makedirs(os.path.join(cache, "datasets"))
+            index = {}
+            for name, path in zip(ADULTS, paths):
+                shutil.copy(path, os.path.join(cache, "datasets"))
+                index[name] = os.path.splitext(os.path.basename(path))[0]
+            with open(os.path.join(cache, "datasets", "index.json"), "w") as f:
+                json.dump(index, f)
+            env = dict(os.environ, SD_RISK_CACHE_DIR=cache, SD_RISK_OFFLINE="1", SD_RISK_LOG_LEVEL="WARNING")
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-child"],
+                                 env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    walls = [run["wall"] for run in runs]
+    return {
+        "runs": len(runs),
+        "latency": _percentiles(walls),
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "exceptions": sorted({ex for run in runs for ex in run["exceptions"]}),
+        "deferred_loaded": sorted({name for run in runs for name in run["deferred_loaded"]}),
+    }
+
+
+def check_startup(summary, target):
+    """Failures of the startup case: exceptions, deferred modules loaded by the first page, or a median above `target` seconds."""
+    failures = [f"startup: {ex}" for ex in summary["exceptions"]]
+    if summary["deferred_loaded"]:
+        failures.append("startup: the first page loads " + ", ".join(summary["deferred_loaded"]))
+    if summary["latency"]["p50"] > target:
+        failures.append(f"startup: p50 time to first render {summary['latency']['p50']:.2f}s vs the {target:.2f}s target")
+    return failures
+
+
+def run_once(case, params):
+    with tempfile.TemporaryDirectory() as cache:
+        env = dict(os.environ, SD_RISK_CACHE_DIR=cache, SD_RISK_OFFLINE="1", SD_RISK_LOG_LEVEL="WARNING")
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps([case, params])],
+                             env=env, cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _percentiles(values):
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+def summarize(runs):
+    """Latency percentiles, throughput and peak memory of the runs of one case."""
+    stage_times = {}
+    for run in runs:
+        per_run = {}
+        for rec in run["stages"]:
+            per_run[rec["stage"]] = per_run.get(rec["stage"], 0.0) + rec["wall"]
+        for name, wall in per_run.items():
+            stage_times.setdefault(name, []).append(wall)
+    columns = [rec["wall"] for run in runs for rec in run["stages"] if rec["stage"] == "inference"]
+    walls = [run["wall"] for run in runs]
+    return {
+        "rows": runs[0]["rows"],
+        "cols": runs[0]["cols"],
+        "runs": len(runs),
+        "latency": _percentiles(walls),
+        "cpu": float(np.median([run["cpu"] for run in runs])),
+        "rows_per_second": runs[0]["rows"] / float(np.median(walls)),
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "stages": {name: _percentiles(values) for name, values in sorted(stage_times.items())},
+        "inference_column": _percentiles(columns) if columns else None,
+    }
+
+
+def cases(rows, cols, seed, adults):
+    out = [{"name": f"synthetic-{n}x{c}", "source": "synthetic", "rows": n, "cols": c, "seed": seed}
+           for n in rows for c in cols]
+    if adults:
+        import datasets
+        import engine
+
+        datasets.OFFLINE = True
+        try:
+            frames = [datasets.load_default(name) for name in ADULTS]
+        except FileNotFoundError as ex:
+            print(f"Skipping the adults datasets: {ex}", file=sys.stderr)
+        else:
+            out.append({"name": "adults", "source": "adults", "aux_cols": engine.DEFAULT_AUX_COLS,
+                        "paths": [datasets._parquet_path(df.attrs[datasets.HASH_ATTR]) for df in frames]})
+    return out
+
+
+def adults_paths():
+    """Cached parquet files of the adults datasets, or None if they aren't in the cache."""
+    import datasets
+
+    datasets.OFFLINE = True
+    try:
+        frames = [datasets.load_default(name) for name in ADULTS]
+    except FileNotFoundError as ex:
+        print(f"Skipping the startup case: {ex}", file=sys.stderr)
+        return None
+    return [datasets._parquet_path(df.attrs[datasets.HASH_ATTR]) for df in frames]
+
+
+def compare(report, baseline, tolerance):
+    """Regressions of `report` against `baseline`: median latency or peak memory above (1 + tolerance) times the baseline."""
+    regressions = []
+    for name, now in report.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for label, new, old in [("p50 latency", now["latency"]["p50"], before["latency"]["p50"]),
+                                ("peak RSS", now["peak_rss_mb"], before["peak_rss_mb"])]:
+            if new > old * (1 + tolerance):
+                regressions.append(f"{name}: {label} {new:.2f} vs {old:.2f} in the baseline")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the singling out / linkability / inference pipeline.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000], help="Row counts of the synthetic tables")
+    parser.add_argument("--cols", type=int, nargs="+", default=[8, 16], help="Column counts of the synthetic tables")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-adults", dest="adults", action="store_false", help="Skip the local adults datasets")
+    parser.add_argument("--sout-attacks", type=int, default=500)
+    parser.add_argument("--link-attacks", type=int, default=2000)
+    parser.add_argument("--neighbors", type=int, default=10)
+    parser.add_argument("--inference-attacks", type=int, default=1000)
+    parser.add_argument("--no-startup", dest="startup", action="store_false", help="Skip the time to first render of the app")
+    parser.add_argument("--startup-repeat", type=int, default=5)
+    parser.add_argument("--startup-target", type=float, default=STARTUP_SECONDS,
+                        help="Largest allowed median time to first render, in seconds")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown before a case counts as a regression")
+    parser.add_argument("--out", help="Also write the full report to this JSON file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    params = {
+        "n_sout_attacks": args.sout_attacks,
+        "n_link_attacks": args.link_attacks,
+        "n_neighbors": args.neighbors,
+        "n_inference_attacks": args.inference_attacks,
+    }
+    if args.child is not None:
+        _child(*json.loads(args.child))
+        return 0
+    if args.startup_child:
+        _startup_child()
+        return 0
+
+    report = {}
+    failures = []
+    paths = adults_paths() if args.startup else None
+    if paths is not None:
+        report["startup"] = summary = run_startup(paths, args.startup_repeat)
+        failures = check_startup(summary, args.startup_target)
+        print(f"{'startup':>28}  p50 {summary['latency']['p50']:8.2f}s  p90 {summary['latency']['p90']:8.2f}s  "
+              f"{'':>19}  peak {summary['peak_rss_mb']:8.1f} MB", flush=True)
+    for case in cases(args.rows, args.cols, args.seed, args.adults):
+        runs = [run_once(case, params) for _ in range(args.repeat)]
+        report[case["name"]] = summary = summarize(runs)
+        print(f"{case['name']:>28}  p50 {summary['latency']['p50']:8.2f}s  p90 {summary['latency']['p90']:8.2f}s  "
+              f"{summary['rows_per_second']:12,.0f} rows/s  peak {summary['peak_rss_mb']:8.1f} MB", flush=True)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    for line in failures:
+        print("REGRESSION " + line)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        return 1 if failures else 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        failures += regressions
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+# Job broker for the multi-user deployment.
+#
+# By default jobs run in a process pool inside the Streamlit server (see
+# jobs.py). With SD_RISK_BROKER set, the UI only queues them here and separate
+# worker processes or containers (worker.py) claim and run them:
+#
+#     SD_RISK_BROKER=sqlite:////data/broker.sqlite   a SQLite file on a shared volume
+#     SD_RISK_BROKER=redis://redis:6379/0            a Redis server
+#
+# Both brokers hand out the queued job of the user with the fewest running
+# jobs first, so one user's heavy evaluations can't starve everyone else.
+# Workers renew a heartbeat while they run a job; the job of a worker that
+# stopped renewing it is queued again, up to MAX_ATTEMPTS times.
+#
+# The records themselves go to the results store (results.py); the broker only
+# keeps the state, the stages and the error of every job.
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+BROKER_URL = os.environ.get("SD_RISK_BROKER")
+STALE_SECONDS = int(os.environ.get("SD_RISK_STALE_SECONDS", "120"))
+MAX_ATTEMPTS = 3
+
+
+class SQLiteBroker:
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user TEXT NOT NULL,
+                state TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                created REAL NOT NULL,
+                heartbeat REAL,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                stages BLOB,
+                error BLOB)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, user)")
+
+    def _connect(self):
+        # One connection per thread: Streamlit serves every session from its own thread
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        return db
+
+    def enqueue(self, job_id, user, job):
+        """Queue a job, unless it is already queued or running. Returns True if it was queued."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is not None and row[0] in ("queued", "running"):
+                return False
+            db.execute("INSERT OR REPLACE INTO jobs (id, user, state, payload, created, attempts) VALUES (?, ?, 'queued', ?, ?, 0)",
+                       (job_id, user, pickle.dumps(job), time.time()))
+            return True
+        finally:
+            db.execute("COMMIT")
+
+    def claim(self, worker):
+        """Mark the next job as running on `worker` and return (job_id, job), or None if nothing is queued."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("""
+                SELECT id, payload FROM jobs AS j WHERE state = 'queued'
+                ORDER BY (SELECT COUNT(*) FROM jobs AS r WHERE r.user = j.user AND r.state = 'running'), created
+                LIMIT 1""").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                       (worker, time.time(), row[0]))
+            return row[0], pickle.loads(row[1])
+        finally:
+            db.execute("COMMIT")
+
+    def heartbeat(self, job_id):
+        self._connect().execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND state = 'running'", (time.time(), job_id))
+
+    def complete(self, job_id, stages):
+        self._connect().execute("UPDATE jobs SET state = 'done', stages = ? WHERE id = ?", (pickle.dumps(stages), job_id))
+
+    def fail(self, job_id, error):
+        self._connect().execute("UPDATE jobs SET state = 'failed', error = ? WHERE id = ?", (_dump_error(error), job_id))
+
+    def requeue_stale(self, timeout=STALE_SECONDS):
+        """Queue the jobs of workers that stopped sending heartbeats again, or fail them after MAX_ATTEMPTS."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            cutoff = time.time() - timeout
+            db.execute("UPDATE jobs SET state = 'failed', error = ? WHERE state = 'running' AND heartbeat < ? AND attempts >= ?",
+                       (_dump_error(RuntimeError("The evaluation was lost by its worker")), cutoff, MAX_ATTEMPTS))
+            db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running' AND heartbeat < ?", (cutoff,))
+        finally:
+            db.execute("COMMIT")
+
+    def status(self, job_id):
+        row = self._connect().execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def error(self, job_id):
+        row = self._connect().execute("SELECT error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None or row[0] is None else pickle.loads(row[0])
+
+    def stages(self, job_id):
+        row = self._connect().execute("SELECT stages FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None or row[0] is None else pickle.loads(row[0])
+
+    def pending(self, user=None):
+        """Number of queued or running jobs, of `user` or of everyone."""
+        query = "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'running')"
+        args = ()
+        if user is not None:
+            query += " AND user = ?"
+            args = (user,)
+        return self._connect().execute(query, args).fetchone()[0]
+
+
+# Checks and requeues the stale running jobs in one atomic step, so that two
+# workers sweeping at the same time can't queue a job twice, and a job that was
+# completed in the meantime is left alone.
+# KEYS: the set of running jobs. ARGV: key prefix, cutoff, MAX_ATTEMPTS, pickled error
+_REQUEUE_STALE = """
+local prefix, cutoff, max_attempts = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local requeued = 0
+for _, job_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local key = prefix .. 'job:' .. job_id
+    local job = redis.call('HMGET', key, 'state', 'heartbeat', 'attempts', 'user')
+    if job[1] ~= 'running' then
+        redis.call('SREM', KEYS[1], job_id)
+    elseif (tonumber(job[2]) or 0) < cutoff then
+        redis.call('SREM', KEYS[1], job_id)
+        redis.call('SREM', prefix .. 'running:' .. job[4], job_id)
+        if tonumber(job[3]) >= max_attempts then
+            redis.call('HSET', key, 'state', 'failed', 'error', ARGV[4])
+        else
+            redis.call('HSET', key, 'state', 'queued')
+            redis.call('LPUSH', prefix .. 'queue:' .. job[4], job_id)
+            requeued = requeued + 1
+        end
+    end
+end
+return requeued
+"""
+
+
+class RedisBroker:
+    # Same protocol on Redis: a hash per job, a queue per user and a set of the
+    # running jobs of every user
+
+    def __init__(self, url, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(f"SD_RISK_BROKER={url} needs the redis package: pip install redis") from None
+            client = redis.Redis.from_url(url)
+        self._redis = client
+        self._prefix = "sd_risk:"
+        self._requeue_stale = self._redis.register_script(_REQUEUE_STALE)
+
+    def _key(self, *parts):
+        return self._prefix + ":".join(parts)
+
+    def enqueue(self, job_id, user, job):
+        key = self._key("job", job_id)
+        if self._redis.hget(key, "state") in (b"queued", b"running"):
+            return False
+        with self._redis.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping={"user": user, "state": "queued", "payload": pickle.dumps(job),
+                                    "created": time.time(), "attempts": 0})
+            pipe.rpush(self._key("queue", user), job_id)
+            pipe.sadd(self._key("users"), user)
+            pipe.execute()
+        return True
+
+    def claim(self, worker):
+        users = sorted((u.decode() for u in self._redis.smembers(self._key("users"))),
+                       key=lambda u: self._redis.scard(self._key("running", u)))
+        for user in users:
+            # LPOP is atomic: a job is only ever handed to one worker
+            job_id = self._redis.lpop(self._key("queue", user))
+            if job_id is None:
+                continue
+            job_id = job_id.decode()
+            key = self._key("job", job_id)
+            with self._redis.pipeline() as pipe:
+                pipe.hset(key, mapping={"state": "running", "worker": worker, "heartbeat": time.time()})
+                pipe.hincrby(key, "attempts", 1)
+                pipe.sadd(self._key("running", user), job_id)
+                pipe.sadd(self._key("running"), job_id)
+                pipe.hget(key, "payload")
+                payload = pipe.execute()[-1]
+            return job_id, pickle.loads(payload)
+        return None
+
+    def heartbeat(self, job_id):
+        self._redis.hset(self._key("job", job_id), "heartbeat", time.time())
+
+    def _finish(self, job_id, mapping):
+        key = self._key("job", job_id)
+        user = self._redis.hget(key, "user").decode()
+        with self._redis.pipeline() as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.srem(self._key("running", user), job_id)
+            pipe.srem(self._key("running"), job_id)
+            pipe.execute()
+
+    def complete(self, job_id, stages):
+        self._finish(job_id, {"state": "done", "stages": pickle.dumps(stages)})
+
+    def fail(self, job_id, error):
+        self._finish(job_id, {"state": "failed", "error": _dump_error(error)})
+
+    def requeue_stale(self, timeout=STALE_SECONDS):
+        """Queue the jobs of workers that stopped sending heartbeats again, or fail them after MAX_ATTEMPTS."""
+        self._requeue_stale(keys=[self._key("running")],
+                            args=[self._prefix, time.time() - timeout, MAX_ATTEMPTS,
+                                  _dump_error(RuntimeError("The evaluation was lost by its worker"))])
+
+    def status(self, job_id):
+        state = self._redis.hget(self._key("job", job_id), "state")
+        return None if state is None else state.decode()
+
+    def error(self, job_id):
+        error = self._redis.hget(self._key("job", job_id), "error")
+        return None if error is None else pickle.loads(error)
+
+    def stages(self, job_id):
+        stages = self._redis.hget(self._key("job", job_id), "stages")
+        return None if stages is None else pickle.loads(stages)
+
+    def pending(self, user=None):
+        users = [u.decode() for u in self._redis.smembers(self._key("users"))] if user is None else [user]
+        return sum(self._redis.llen(self._key("queue", u)) + self._redis.scard(self._key("running", u)) for u in users)
+
+
+def _dump_error(error):
+    # Exceptions are pickled so that the UI can re-raise them, e.g. singling out's RuntimeError
+    try:
+        return pickle.dumps(error)
+    except Exception:
+        return pickle.dumps(RuntimeError(str(error)))
+
+
+_broker = None
+_lock = threading.Lock()
+
+
+def connect(url=BROKER_URL):
+    """The broker configured with SD_RISK_BROKER, or None to run jobs in-process."""
+    global _broker
+    if url is None:
+        return None
+    with _lock:
+        if _broker is None:
+            parsed = urlparse(url)
+            if parsed.scheme == "sqlite":
+                # sqlite:////abs/path or sqlite:///relative/path
+                _broker = SQLiteBroker(parsed.path[1:] if parsed.path.startswith("//") else parsed.path.lstrip("/"))
+            elif parsed.scheme in ("redis", "rediss"):
+                _broker = RedisBroker(url)
+            else:
+                raise ValueError(f"Unsupported broker {url}, use sqlite:///path or redis://host:port/db")
+        return _broker
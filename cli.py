@@ -0,0 +1,173 @@
+# Headless risk reports.
+#
+# Runs the same singling out / linkability / inference workflow as "Analyze
+# All" for any number of synthetic candidates against one original and control
+# dataset, and writes one JSON report per candidate or a single Parquet table.
+#
+#     python cli.py --ori train.csv --control control.csv --syn 'releases/*.csv' --out reports/
+#
+# The original and control data are parsed once and shared with the worker
+# processes through the dataset cache.
+
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import as_completed
+
+import pandas as pd
+
+import datasets
+import engine
+import jobs
+import profiling
+
+
+def _paths(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No file matches {pattern}")
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def _one(pattern):
+    paths = _paths([pattern])
+    if len(paths) > 1:
+        raise ValueError(f"{pattern} matches {len(paths)} files, expected one")
+    return paths[0]
+
+
+def _init_worker(cpus):
+    engine.N_JOBS = cpus
+
+
+def _analyze(ori_hash, syn_path, control_hash, params):
+    with profiling.collect() as stages:
+        ori = datasets.load_hash(ori_hash)
+        control = None if control_hash is None else datasets.load_hash(control_hash)
+        report = engine.analyze(ori, datasets.load_path(syn_path), control, **params)
+    return report, stages
+
+
+def report_names(paths):
+    """Name of the JSON report of every synthetic path: its path below the common directory, without extension.
+
+    Candidates with the same file name in different directories keep their
+    directories (`runA/syn`, `runB/syn`). Raises ValueError if two paths
+    would still share a report.
+    """
+    full = [os.path.abspath(path) for path in paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in full]) if full else ""
+    names = {}
+    for path, absolute in zip(paths, full):
+        name = os.path.splitext(os.path.relpath(absolute, root))[0]
+        if name in names.values():
+            other = next(p for p, n in names.items() if n == name)
+            raise ValueError(f"{other} and {path} would both be reported as {name}.json")
+        names[path] = name
+    return names
+
+
+def rows(name, report):
+    """Flatten a report into one row per (risk, secret column)."""
+    out = []
+    for kind, section in report.items():
+        columns = section.get("columns", {}) if "error" not in section else {}
+        for secret, summary in [(None, section)] + list(columns.items()):
+            row = {"syn": name, "risk_type": kind, "secret": secret}
+            row.update({k: v for k, v in summary.items() if k != "columns"})
+            if "ci" in row:
+                row["ci_low"], row["ci_high"] = row.pop("ci")
+            if "baseline_ci" in row:
+                row["baseline_ci_low"], row["baseline_ci_high"] = row.pop("baseline_ci")
+            out.append(row)
+    return out
+
+
+def run(ori_path, syn_paths, control_path=None, workers=1, **params):
+    """Yield (syn_path, report) for every synthetic candidate as soon as it is finished."""
+    ori = datasets.load_path(ori_path)
+    control = None if control_path is None else datasets.load_path(control_path)
+    ori_hash = datasets.persist(ori)
+    control_hash = None if control is None else datasets.persist(control)
+
+    if workers == 1:
+        for path in syn_paths:
+            yield path, engine.analyze(ori, datasets.load_path(path), control, **params)
+        return
+
+    cpus = max(1, (os.cpu_count() or 1) // workers)
+    with jobs.ProcessPool(workers, initializer=_init_worker, initargs=(cpus,)) as pool:
+        futures = {pool.submit(_analyze, ori_hash, path, control_hash, params): path for path in syn_paths}
+        for future in as_completed(futures):
+            report, stages = future.result()
+            profiling.extend(stages)
+            yield futures[future], report
+
+
+def _write(args, syn_paths, control_path, params):
+    table = []
+    names = report_names(syn_paths)
+    for path, report in run(_one(args.ori), syn_paths, control_path, args.workers, **params):
+        if args.format == "json":
+            out = os.path.join(args.out, names[path] + ".json")
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, "w") as f:
+                json.dump({"syn": path, **report}, f, indent=2)
+        else:
+            table.extend(rows(path, report))
+        print(f"{path}: done", file=sys.stderr)
+
+    if args.format == "parquet":
+        pd.DataFrame(table).to_parquet(os.path.join(args.out, "risk_report.parquet"), index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the privacy risk of synthetic datasets with Anonymeter.")
+    parser.add_argument("--ori", required=True, help="Original (training) dataset, CSV")
+    parser.add_argument("--syn", required=True, nargs="+", help="Synthetic datasets, CSV paths or globs")
+    parser.add_argument("--control", help="Control (holdout) dataset, CSV")
+    parser.add_argument("--out", default="reports", help="Output directory")
+    parser.add_argument("--format", choices=["json", "parquet"], default="json")
+    parser.add_argument("--workers", type=int, default=1, help="Synthetic datasets evaluated in parallel")
+    parser.add_argument("--sout-attacks", type=int, default=500)
+    parser.add_argument("--sout-mode", choices=["univariate", "multivariate"], default="univariate")
+    parser.add_argument("--sout-time-budget", type=float, metavar="SECONDS",
+                        help="Stop the multivariate query search after this long and estimate from the queries found")
+    parser.add_argument("--link-attacks", type=int, default=2000)
+    parser.add_argument("--neighbors", type=int, default=10)
+    parser.add_argument("--aux-cols", nargs=2, metavar=("COLS_A", "COLS_B"),
+                        help="Comma separated auxiliary columns of the two linkability datasets")
+    parser.add_argument("--inference-attacks", type=int, default=1000)
+    parser.add_argument("--confidence-level", type=float, default=0.95, help="Confidence level of the reported intervals")
+    parser.add_argument("--profile", metavar="PSTATS",
+                        help="Run under cProfile and save the statistics to this file (use with --workers 1)")
+    args = parser.parse_args(argv)
+
+    params = {
+        "n_sout_attacks": args.sout_attacks,
+        "n_link_attacks": args.link_attacks,
+        "n_neighbors": args.neighbors,
+        "aux_cols": engine.DEFAULT_AUX_COLS if args.aux_cols is None else [c.split(",") for c in args.aux_cols],
+        "n_inference_attacks": args.inference_attacks,
+        "sout_mode": args.sout_mode,
+        "sout_time_budget": args.sout_time_budget,
+        "confidence_level": args.confidence_level,
+    }
+    syn_paths = _paths(args.syn)
+    control_path = None if args.control is None else _one(args.control)
+    os.makedirs(args.out, exist_ok=True)
+
+    if args.profile is not None:
+        with profiling.cprofile(os.path.abspath(args.profile)):
+            _write(args, syn_paths, control_path, params)
+    else:
+        _write(args, syn_paths, control_path, params)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# Dataset loading for the app: a content-addressed cache of parsed frames.
+#
+# Every dataset is identified by the sha256 of its raw CSV bytes. Parsed frames
+# are kept in a small in-memory LRU and persisted as uncompressed Arrow IPC files
+# under CACHE_DIR, so Streamlit reruns and container restarts neither re-download
+# nor re-parse.
+# With SD_RISK_OFFLINE=1 the default datasets are only ever read from the cache
+# (or from CSV files dropped into CACHE_DIR/seed), never from the network.
+#
+# CSVs are ingested in chunks: a first pass infers a compact schema (small int
+# types, float32 where it is lossless, categoricals for repeated strings) and a
+# second pass writes the chunks to an Arrow file. A multi-GB upload is never
+# parsed with default dtypes at once.
+#
+# Cached files are opened with a memory map and converted to pandas without
+# copying: numeric columns (missing floats are stored as NaN rather than as
+# nulls) and the codes of categoricals are read-only views of the mapped file,
+# so they live in the page cache instead of the process's own memory. Other
+# columns, e.g. ints with missing values, are copied on load.
+
+import hashlib
+import io
+import json
+import os
+import threading
+import urllib.request
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import profiling
+
+BUCKET_URL = "https://storage.googleapis.com/statice-public/anonymeter-datasets/"
+DEFAULT_DATASETS = ["adults_train.csv", "adults_syn_ctgan.csv", "adults_control.csv"]
+
+CACHE_DIR = os.environ.get("SD_RISK_CACHE_DIR",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+OFFLINE = os.environ.get("SD_RISK_OFFLINE", "0") == "1"
+MEMORY_SLOTS = int(os.environ.get("SD_RISK_MEMORY_DATASETS", "8"))
+CHUNK_ROWS = int(os.environ.get("SD_RISK_CHUNK_ROWS", "200000"))
+CATEGORY_LIMIT = 10000
+
+HASH_ATTR = "sd_risk_hash"
+
+_frames = OrderedDict()
+_lock = threading.Lock()
+
+
+def _datasets_dir():
+    path = os.path.join(CACHE_DIR, "datasets")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _arrow_path(digest):
+    return os.path.join(_datasets_dir(), digest + ".arrow")
+
+
+def _index_path():
+    return os.path.join(_datasets_dir(), "index.json")
+
+
+def _read_index():
+    try:
+        with open(_index_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(index):
+    tmp = _index_path() + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp, _index_path())
+
+
+def content_hash(f):
+    """sha256 of a binary file object, read in blocks. The file is rewound afterwards."""
+    h = hashlib.sha256()
+    for block in iter(lambda: f.read(1 << 20), b""):
+        h.update(block)
+    f.seek(0)
+    return h.hexdigest()
+
+
+def _remember(digest, df):
+    df.attrs[HASH_ATTR] = digest
+    with _lock:
+        _frames[digest] = df
+        _frames.move_to_end(digest)
+        while len(_frames) > MEMORY_SLOTS:
+            _frames.popitem(last=False)
+    return df
+
+
+def _recall(digest):
+    with _lock:
+        df = _frames.get(digest)
+        if df is not None:
+            _frames.move_to_end(digest)
+        return df
+
+
+def _write(path, table):
+    # Write to a temporary file first so a crash never leaves a truncated file behind.
+    # Chunks are combined into a single record batch: pandas can only map columns
+    # that are contiguous in the file
+    tmp = path + ".%d.tmp" % os.getpid()
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table.combine_chunks())
+    os.replace(tmp, path)
+
+
+def _store(digest, df):
+    _write(_arrow_path(digest), pa.Table.from_pandas(df, preserve_index=False))
+
+
+def load_hash(digest):
+    """Return the cached frame for a content hash, from memory or from disk."""
+    df = _recall(digest)
+    if df is not None:
+        return df
+    path = _arrow_path(digest)
+    if not os.path.exists(path):
+        raise KeyError(f"Dataset {digest} is not in the cache at {CACHE_DIR}")
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return _remember(digest, table.to_pandas(split_blocks=True))
+
+
+def _chunks(f):
+    f.seek(0)
+    return pd.read_csv(f, chunksize=CHUNK_ROWS, low_memory=False)
+
+
+def _infer_schema(f):
+    # Per column: "int", "float" or "str", the value range, whether float32 is
+    # lossless and the distinct values as long as there are few enough of them
+    stats = {}
+    for chunk in _chunks(f):
+        for col in chunk.columns:
+            s = chunk[col]
+            info = stats.setdefault(col, {"kind": "int", "min": None, "max": None,
+                                        "float32": True, "values": set()})
+            if pd.api.types.is_bool_dtype(s) or not pd.api.types.is_numeric_dtype(s):
+                info["kind"] = "str"
+            elif pd.api.types.is_float_dtype(s) and info["kind"] == "int":
+                info["kind"] = "float"
+            if info["kind"] != "str" and pd.api.types.is_numeric_dtype(s) and s.notna().any():
+                lo, hi = s.min(), s.max()
+                info["min"] = lo if info["min"] is None else min(info["min"], lo)
+                info["max"] = hi if info["max"] is None else max(info["max"], hi)
+                # Integer chunks count too: a later chunk with a NaN or a fraction turns the
+                # whole column into floats
+                values = s[s.notna()]
+                info["float32"] &= bool((values.astype(np.float32).astype(np.float64) == values).all())
+            if info["values"] is not None:
+                info["values"].update(str(v) for v in s.dropna().unique())
+                if len(info["values"]) > CATEGORY_LIMIT:
+                    info["values"] = None
+
+    dtypes = {}
+    for col, info in stats.items():
+        if info["kind"] == "int" and info["min"] is not None:
+            # Both bounds have to fit, and so does the range: evaluators subtract min
+            # from max in the column's type
+            lo, hi = int(info["min"]), int(info["max"])
+            dtypes[col] = next((t for t in (np.int8, np.int16, np.int32)
+                                if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max
+                                and hi - lo <= np.iinfo(t).max), np.int64)
+        elif info["kind"] in ("int", "float"):
+            dtypes[col] = np.float32 if info["float32"] else np.float64
+        elif info["values"] is not None:
+            dtypes[col] = pd.CategoricalDtype(sorted(info["values"]))
+        else:
+            dtypes[col] = "str"
+    return dtypes
+
+
+def _convert(chunk, dtypes):
+    for col, dtype in dtypes.items():
+        s = chunk[col]
+        if isinstance(dtype, pd.CategoricalDtype) or dtype == "str":
+            s = s.astype(object).where(s.isna(), s.astype(str))
+        chunk[col] = s.astype(dtype)
+    return chunk
+
+
+def _arrow(chunk):
+    # NaN stays a float value instead of becoming a null, so float columns can be mapped
+    return pa.table({col: pa.array(s, from_pandas=not pd.api.types.is_float_dtype(s)) for col, s in chunk.items()})
+
+
+def _ingest(f, digest):
+    with profiling.stage("infer_schema"):
+        dtypes = _infer_schema(f)
+    path = _arrow_path(digest)
+    chunks = path + ".%d.chunks" % os.getpid()
+    writer = schema = None
+    with profiling.stage("ingest", rows=0, cols=len(dtypes)) as rec:
+        try:
+            for chunk in _chunks(f):
+                table = _arrow(_convert(chunk, dtypes))
+                if writer is None:
+                    schema = table.schema
+                    writer = pa.ipc.new_file(chunks, schema)
+                writer.write_table(table.cast(schema))
+                rec["rows"] += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    if writer is None:
+        # No data rows: keep the header
+        f.seek(0)
+        _write(path, pa.Table.from_pandas(pd.read_csv(f), preserve_index=False))
+        return
+    try:
+        # Only the combined table is held in memory, the chunks are read from the map
+        _write(path, pa.ipc.open_file(pa.memory_map(chunks)).read_all())
+    finally:
+        os.remove(chunks)
+
+
+def load_file(f):
+    """Ingest a binary CSV file object, reusing the cached frame when the content was seen before."""
+    digest = content_hash(f)
+    try:
+        return load_hash(digest)
+    except KeyError:
+        pass
+    _ingest(f, digest)
+    return load_hash(digest)
+
+
+def load_bytes(data):
+    return load_file(io.BytesIO(data))
+
+
+def load_path(path):
+    """Load a local CSV file through the cache."""
+    with open(path, "rb") as f:
+        return load_file(f)
+
+
+def load_upload(uploaded_file, digests=None):
+    """Load a Streamlit UploadedFile through the cache.
+
+    `digests` maps the `file_id` of earlier uploads to their content hash,
+    e.g. a dict kept in st.session_state, so that reruns only hash new uploads.
+    """
+    digest = None if digests is None else digests.get(uploaded_file.file_id)
+    if digest is not None:
+        try:
+            return load_hash(digest)
+        except KeyError:
+            pass
+    df = load_file(uploaded_file)
+    if digests is not None:
+        digests[uploaded_file.file_id] = df.attrs[HASH_ATTR]
+    return df
+
+
+def preview(df, n=1000):
+    """A reproducible sample of at most `n` rows, for display."""
+    if len(df) <= n:
+        return df
+    return df.sample(n, random_state=0).sort_index()
+
+
+def _fetch(name):
+    seed = os.path.join(CACHE_DIR, "seed", name)
+    if os.path.exists(seed):
+        return load_path(seed)
+    if OFFLINE:
+        raise FileNotFoundError(
+            f"{name} is not cached and SD_RISK_OFFLINE is set. "
+            f"Run `python datasets.py` while online or copy it to {seed}.")
+    with profiling.stage("download", dataset=name):
+        with urllib.request.urlopen(BUCKET_URL + name) as response:
+            data = response.read()
+    return load_bytes(data)
+
+
+def load_default(name):
+    """Load one of the default adults datasets, hitting the network only on the first use."""
+    index = _read_index()
+    digest = index.get(name)
+    if digest is not None:
+        try:
+            return load_hash(digest)
+        except KeyError:
+            pass
+    df = _fetch(name)
+    index = _read_index()
+    index[name] = df.attrs[HASH_ATTR]
+    _write_index(index)
+    return df
+
+
+def persist(df):
+    """Make sure a frame can be reloaded by its fingerprint, e.g. from a worker process."""
+    digest = fingerprint(df)
+    if not os.path.exists(_arrow_path(digest)):
+        _store(digest, df)
+    _remember(digest, df)
+    return digest
+
+
+def fingerprint(df):
+    """Content hash of a frame: the hash it was loaded with, or a hash of its values."""
+    digest = df.attrs.get(HASH_ATTR)
+    if digest is None:
+        h = hashlib.sha256()
+        h.update(json.dumps([str(c) for c in df.columns]).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+        digest = h.hexdigest()
+        df.attrs[HASH_ATTR] = digest
+    return digest
+
+
+if __name__ == "__main__":
+    # Pre-seed the cache, e.g. while building an image that will run offline
+    for name in DEFAULT_DATASETS:
+        df = load_default(name)
+        print(f"{name}: {df.shape[0]} rows -> {df.attrs[HASH_ATTR]}")
@@ -0,0 +1,273 @@
+# Shared numeric encoding of the ori/syn/control frames.
+#
+# Anonymeter encodes and rescales the data inside every evaluator, so a sweep
+# over all secret columns repeats the same preprocessing once per column. Here
+# the frames are encoded a single time into float arrays (numerical columns
+# divided by their range, categorical columns label encoded) that are saved as
+# .npy files and memory-mapped by every worker process.
+#
+# The original and control data are encoded once into an "original profile"
+# (CACHE_DIR/originals/<key>): the encoded target records, the numerical
+# ranges and categories they were fitted on and some column statistics. Every
+# synthetic dataset is then encoded against that profile, so a new synthetic
+# release only pays for its own encoding. Synthetic values outside the range
+# simply scale to distances above one, and unseen synthetic categories get
+# codes of their own.
+#
+# A synthetic dataset that extends an earlier one with appended rows reuses
+# the encoding of the earlier rows, and records it as its parent so that the
+# neighbour indexes can be updated instead of recomputed (see neighbors.py).
+
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import datasets
+import profiling
+
+CHUNK_ELEMENTS = 2 ** 22
+# Part of every key: bump it when the encoding changes
+VERSION = 2
+
+
+def _encodings_dir(key):
+    return os.path.join(datasets.CACHE_DIR, "encodings", key)
+
+
+def _profile_dir(key):
+    return os.path.join(datasets.CACHE_DIR, "originals", key)
+
+
+def encoding_key(ori, syn, control):
+    blob = "|".join([str(VERSION)] + [datasets.fingerprint(df) for df in (ori, syn, control) if df is not None])
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def profile_key(ori, control):
+    blob = "|".join([str(VERSION), "profile"] + [datasets.fingerprint(df) for df in (ori, control) if df is not None])
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def _column_types(frames):
+    # Same rule as anonymeter: a column is numerical only if it is numerical everywhere
+    num = [col for col in frames[0].columns
+           if all(pd.api.types.is_numeric_dtype(df[col]) for df in frames)]
+    cat = [col for col in frames[0].columns if col not in num]
+    return num, cat
+
+
+def _column_stats(reference, num, cat):
+    stats = {}
+    for col in num:
+        values = reference[col]
+        stats[col] = {"min": float(values.min()), "max": float(values.max()), "mean": float(values.mean()),
+                      "missing": int(values.isna().sum())}
+    for col in cat:
+        stats[col] = {"categories": int(reference[col].nunique()), "missing": int(reference[col].isna().sum())}
+    return stats
+
+
+def profile(ori, control=None):
+    """Encode the original and control data once and return their profile.
+
+    Returns a dict with the column order, a boolean mask of numerical columns,
+    the numerical ranges, the categories of every categorical column, column
+    statistics and the memory-mapped targets: the encoded original records
+    followed by the control records.
+    """
+    key = profile_key(ori, control)
+    path = _profile_dir(key)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        frames = [ori] if control is None else [ori, control]
+        with profiling.stage("profile", rows=sum(len(df) for df in frames), cols=ori.shape[1]):
+            num, cat = _column_types(frames)
+            reference = pd.concat([df[num + cat] for df in frames], ignore_index=True)
+            ranges = (reference[num].max() - reference[num].min()).replace(0, 1)
+            targets = np.empty((len(reference), len(num) + len(cat)), dtype=np.float64)
+            for j, col in enumerate(num):
+                targets[:, j] = reference[col].to_numpy(dtype=np.float64, na_value=np.nan) / ranges[col]
+            categories = {}
+            for j, col in enumerate(cat, start=len(num)):
+                codes, uniques = pd.factorize(reference[col].astype(object), use_na_sentinel=True)
+                targets[:, j] = np.where(codes < 0, np.nan, codes)
+                categories[col] = list(uniques)
+            os.makedirs(path, exist_ok=True)
+            np.save(os.path.join(path, "targets.npy"), targets)
+            with open(os.path.join(path, "categories.pkl"), "wb") as f:
+                pickle.dump(categories, f)
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump({"columns": num + cat, "num": num, "ranges": [float(ranges[col]) for col in num],
+                           "n_ori": len(ori), "n_control": 0 if control is None else len(control),
+                           "stats": _column_stats(reference, num, cat)}, f)
+    return load_profile(key)
+
+
+def load_profile(key):
+    path = _profile_dir(key)
+    with open(os.path.join(path, "meta.json")) as f:
+        prof = json.load(f)
+    with open(os.path.join(path, "categories.pkl"), "rb") as f:
+        prof["categories"] = pickle.load(f)
+    prof["key"] = key
+    prof["is_num"] = np.array([col in prof["num"] for col in prof["columns"]])
+    prof["targets"] = np.load(os.path.join(path, "targets.npy"), mmap_mode="r")
+    return prof
+
+
+def _encode_syn(prof, syn, extra):
+    # Encode against the profile. `extra` holds the unseen categories met so
+    # far, in the order their codes were given, and is extended in place.
+    arr = np.empty((len(syn), len(prof["columns"])), dtype=np.float64)
+    for j, (col, rng) in enumerate(zip(prof["num"], prof["ranges"])):
+        # A column that is numerical in the original data is compared as a number
+        values = pd.to_numeric(syn[col], errors="coerce")
+        arr[:, j] = values.to_numpy(dtype=np.float64, na_value=np.nan) / rng
+    for j, col in enumerate(prof["columns"][len(prof["num"]):], start=len(prof["num"])):
+        values = syn[col].astype(object)
+        missing = values.isna().to_numpy()
+        known = pd.Index(prof["categories"][col] + extra.setdefault(col, []))
+        codes = known.get_indexer(values)
+        unseen = (codes < 0) & ~missing
+        if unseen.any():
+            extra[col].extend(pd.unique(values[unseen]))
+            codes = pd.Index(prof["categories"][col] + extra[col]).get_indexer(values)
+        arr[:, j] = np.where(missing, np.nan, codes)
+    return arr
+
+
+def _row_digest(row_hashes):
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()
+
+
+def _registry_path(prof):
+    return os.path.join(_profile_dir(prof["key"]), "syns.json")
+
+
+def _read_registry(prof):
+    try:
+        with open(_registry_path(prof)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _register(prof, key, row_hashes):
+    registry = [entry for entry in _read_registry(prof) if entry["key"] != key]
+    registry.append({"key": key, "rows": len(row_hashes), "row_digest": _row_digest(row_hashes)})
+    tmp = f"{_registry_path(prof)}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(registry, f)
+    os.replace(tmp, _registry_path(prof))
+
+
+def _find_parent(prof, row_hashes):
+    # The longest synthetic dataset encoded before whose rows are a prefix of these ones
+    best = None
+    for entry in _read_registry(prof):
+        if (0 < entry["rows"] < len(row_hashes)
+                and (best is None or entry["rows"] > best["rows"])
+                and os.path.exists(os.path.join(_encodings_dir(entry["key"]), "meta.json"))
+                and _row_digest(row_hashes[:entry["rows"]]) == entry["row_digest"]):
+            best = entry
+    return best
+
+
+def encode(ori, syn, control=None):
+    """Encode the synthetic data against the profile of ori/control and return memory-mapped arrays.
+
+    Returns a dict with the column order, a boolean mask of numerical columns,
+    the encoded synthetic data and the encoded targets: the original records
+    followed by the control records.
+    """
+    prof = profile(ori, control)
+    key = encoding_key(ori, syn, control)
+    path = _encodings_dir(key)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        row_hashes = pd.util.hash_pandas_object(syn[prof["columns"]], index=False).to_numpy()
+        parent = _find_parent(prof, row_hashes)
+        with profiling.stage("encode", rows=len(syn), cols=syn.shape[1], appended_to=parent and parent["key"]):
+            if parent is None:
+                extra = {}
+                encoded = _encode_syn(prof, syn, extra)
+            else:
+                # Appended rows: only they need to be encoded
+                parent_path = _encodings_dir(parent["key"])
+                with open(os.path.join(parent_path, "extra.pkl"), "rb") as f:
+                    extra = pickle.load(f)
+                new = _encode_syn(prof, syn.iloc[parent["rows"]:], extra)
+                encoded = np.vstack([np.load(os.path.join(parent_path, "syn.npy"), mmap_mode="r"), new])
+            os.makedirs(path, exist_ok=True)
+            np.save(os.path.join(path, "syn.npy"), encoded)
+            with open(os.path.join(path, "extra.pkl"), "wb") as f:
+                pickle.dump(extra, f)
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump({"profile": prof["key"],
+                           "parent": None if parent is None else parent["key"],
+                           "parent_rows": 0 if parent is None else parent["rows"]}, f)
+        _register(prof, key, row_hashes)
+    return load(key)
+
+
+def load(key):
+    path = _encodings_dir(key)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    prof = load_profile(meta["profile"])
+    meta.update({name: prof[name] for name in ("columns", "num", "is_num", "n_ori", "targets")})
+    meta["key"] = key
+    meta["syn"] = np.load(os.path.join(path, "syn.npy"), mmap_mode="r")
+    return meta
+
+
+def column_index(enc, columns):
+    return [enc["columns"].index(col) for col in columns]
+
+
+def distance(a, b, is_num):
+    """Gower-like distance between broadcastable arrays of encoded records (last axis: columns).
+
+    Numerical columns contribute their absolute difference, categorical ones
+    contribute one if they differ. Missing values always count as a mismatch.
+    """
+    d = np.where(is_num, np.abs(a - b), (a != b).astype(np.float64))
+    return np.where(np.isnan(d), 1.0, d).sum(axis=-1)
+
+
+def kneighbors(queries, candidates, is_num, n_neighbors, return_distance=False):
+    """Indices of the closest candidates for every query, see `distance`, and optionally their distances."""
+    n_neighbors = min(n_neighbors, candidates.shape[0])
+    out = np.empty((queries.shape[0], n_neighbors), dtype=np.int64)
+    out_dist = np.empty((queries.shape[0], n_neighbors)) if return_distance else None
+    step = max(1, CHUNK_ELEMENTS // max(1, candidates.shape[0]))
+    for start in range(0, queries.shape[0], step):
+        q = queries[start:start + step]
+        dist = np.zeros((q.shape[0], candidates.shape[0]))
+        for j in range(q.shape[1]):
+            if is_num[j]:
+                d = np.abs(q[:, j, None] - candidates[None, :, j])
+            else:
+                d = (q[:, j, None] != candidates[None, :, j]).astype(np.float64)
+            dist += np.where(np.isnan(d), 1.0, d)
+        if n_neighbors < candidates.shape[0]:
+            part = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        else:
+            part = np.broadcast_to(np.arange(candidates.shape[0]), dist.shape)
+        part_dist = np.take_along_axis(dist, part, axis=1)
+        order = np.argsort(part_dist, axis=1, kind="stable")
+        out[start:start + step] = np.take_along_axis(part, order, axis=1)
+        if return_distance:
+            out_dist[start:start + step] = np.take_along_axis(part_dist, order, axis=1)
+    return (out, out_dist) if return_distance else out
+
+
+def target_frames(enc, ori, control):
+    """Re-index ori and control by their row in the encoded targets."""
+    n_ori = enc["n_ori"]
+    ori = ori.set_axis(pd.RangeIndex(0, n_ori))
+    if control is not None:
+        control = control.set_axis(pd.RangeIndex(n_ori, n_ori + len(control)))
+    return ori, control
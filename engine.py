@@ -0,0 +1,238 @@
+# Risk evaluations used by the app, decoupled from Streamlit.
+#
+# Each function returns a plain result record (a dict holding anonymeter's
+# EvaluationResults plus whatever the UI needs to show) and goes through the
+# results cache, so identical evaluations are only ever run once.
+
+import os
+from concurrent.futures import as_completed
+
+import numpy as np
+from anonymeter.evaluators import SinglingOutEvaluator
+from anonymeter.evaluators import InferenceEvaluator
+from anonymeter.evaluators.linkability_evaluator import LinkabilityIndexes
+from anonymeter.stats.confidence import EvaluationResults
+
+import datasets
+import encoding
+import jobs
+import multivariate
+import neighbors
+import profiling
+import results
+import stats
+
+N_JOBS = -2  # n_jobs follow joblib convention. -1 = all cores, -2 = all execept one
+
+DEFAULT_AUX_COLS = [
+    ['type_employer', 'education', 'hr_per_week', 'capital_loss', 'capital_gain'],
+    ['race', 'sex', 'fnlwgt', 'age', 'country']
+]
+
+
+def singling_out(ori, syn, control, n_attacks, mode='univariate', time_budget=None):
+    params = {"n_attacks": n_attacks, "mode": mode}
+    if mode == 'multivariate':
+        # Bitmask query search, see multivariate.py
+        params.update(search="bitmask", time_budget=time_budget)
+        return results.cached("singling_out", (ori, syn, control), params,
+                              lambda: multivariate.singling_out(ori, syn, control, n_attacks, time_budget=time_budget,
+                                                                n_workers=_n_workers()))
+
+    def compute():
+        evaluator = SinglingOutEvaluator(ori=ori,
+                                         syn=syn,
+                                         control=control,
+                                         n_attacks=n_attacks)
+        with profiling.stage("singling_out", rows=len(ori), cols=ori.shape[1], mode=mode):
+            evaluator.evaluate(mode=mode)
+        return {"results": evaluator.results(),
+                "queries": [str(q) for q in evaluator.queries()]}
+
+    return results.cached("singling_out", (ori, syn, control), params, compute)
+
+
+def random_links(rng, n_synthetic, n_attacks, n_neighbors):
+    """Number of links found by the baseline attack, which picks neighbours at random."""
+    def links():
+        return np.array([rng.choice(n_synthetic, size=n_neighbors, replace=False) for _ in range(n_attacks)])
+    return LinkabilityIndexes(idx_0=links(), idx_1=links()).count_links(n_neighbors=n_neighbors)
+
+
+def count_links(enc, rows, aux_cols, n_neighbors):
+    """Number of target `rows` whose two halves share one of their `n_neighbors` closest synthetic records."""
+    idx_0 = neighbors.lookup(enc, aux_cols[0], rows, n_neighbors)
+    idx_1 = neighbors.lookup(enc, aux_cols[1], rows, n_neighbors)
+    return LinkabilityIndexes(idx_0=idx_0, idx_1=idx_1).count_links(n_neighbors=n_neighbors)
+
+
+def _linkability_params(n_attacks, aux_cols, n_neighbors, seed):
+    return {"n_attacks": n_attacks, "aux_cols": [list(cols) for cols in aux_cols], "n_neighbors": n_neighbors,
+            "seed": seed, "index": "encoded-knn"}
+
+
+def linkability(ori, syn, control, n_attacks, aux_cols, n_neighbors, seed=0):
+    aux_cols = [list(cols) for cols in aux_cols]
+    params = _linkability_params(n_attacks, aux_cols, n_neighbors, seed)
+
+    def compute():
+        # Same attack as anonymeter's LinkabilityEvaluator, on the persistent neighbour index
+        enc = encoding.encode(ori, syn, control)
+        with profiling.stage("linkability", rows=n_attacks, cols=sum(len(cols) for cols in aux_cols)):
+            rng = np.random.default_rng(seed)
+            targets = rng.choice(len(ori), size=n_attacks, replace=False)
+            n_control = None
+            if control is not None:
+                control_targets = len(ori) + rng.choice(len(control), size=n_attacks, replace=False)
+                n_control = count_links(enc, control_targets, aux_cols, n_neighbors)
+            evaluation = EvaluationResults(n_attacks=n_attacks,
+                                           n_success=count_links(enc, targets, aux_cols, n_neighbors),
+                                           n_baseline=random_links(rng, len(syn), n_attacks, n_neighbors),
+                                           n_control=n_control)
+        return {"results": evaluation}
+
+    return results.cached("linkability", (ori, syn, control), params, compute)
+
+
+def _inference_params(secret, aux_cols, n_attacks):
+    return {"secret": secret, "aux_cols": list(aux_cols), "n_attacks": n_attacks, "predictor": "indexed-knn"}
+
+
+def _evaluate_inference(enc, ori, syn, control, secret, aux_cols, n_attacks):
+    ori, control = encoding.target_frames(enc, ori, control)
+    evaluator = InferenceEvaluator(ori=ori,
+                                   syn=syn,
+                                   control=control,
+                                   aux_cols=list(aux_cols),
+                                   secret=secret,
+                                   n_attacks=n_attacks,
+                                   inference_model=neighbors.IndexedKNNPredictor(enc, syn, aux_cols, secret))
+    with profiling.stage("inference", rows=n_attacks, cols=len(aux_cols), secret=secret):
+        evaluator.evaluate(n_jobs=1)
+    return {"results": evaluator.results()}
+
+
+def _sweep_worker(hashes, enc_key, secret, aux_cols, n_attacks):
+    ori, syn, control = [None if h is None else datasets.load_hash(h) for h in hashes]
+    with profiling.collect() as stages:
+        record = _evaluate_inference(encoding.load(enc_key), ori, syn, control, secret, aux_cols, n_attacks)
+    return record, stages
+
+
+def _n_workers():
+    if N_JOBS > 0:
+        return N_JOBS
+    return max(1, (os.cpu_count() or 1) + 1 + N_JOBS)
+
+
+def inference(ori, syn, control, secret, aux_cols, n_attacks=1000):
+    params = _inference_params(secret, aux_cols, n_attacks)
+
+    def compute():
+        enc = encoding.encode(ori, syn, control)
+        return _evaluate_inference(enc, ori, syn, control, secret, aux_cols, n_attacks)
+
+    return results.cached("inference", (ori, syn, control), params, compute)
+
+
+def _sweep_keys(ori, syn, control, n_attacks, secrets):
+    columns = list(ori.columns)
+    for secret in secrets:
+        aux_cols = [col for col in columns if col != secret]
+        key = results.make_key("inference", (ori, syn, control), _inference_params(secret, aux_cols, n_attacks))
+        yield secret, aux_cols, key
+
+
+def inference_sweep(ori, syn, control, n_attacks=1000, secrets=None):
+    """Yield (secret, results) for every secret column as soon as it is finished.
+
+    Every column is attacked using all the other columns as auxiliary
+    information. The frames are encoded once and the secrets are spread over
+    a process pool that memory-maps the shared encoding.
+    """
+    secrets = list(ori.columns) if secrets is None else list(secrets)
+    todo = []
+    for secret, aux_cols, key in _sweep_keys(ori, syn, control, n_attacks, secrets):
+        record = results.get(key)
+        if record is None:
+            todo.append((secret, aux_cols, key))
+        else:
+            yield secret, record["results"]
+    if not todo:
+        return
+
+    enc = encoding.encode(ori, syn, control)
+    if _n_workers() == 1 or len(todo) == 1:
+        for secret, aux_cols, key in todo:
+            record = _evaluate_inference(enc, ori, syn, control, secret, aux_cols, n_attacks)
+            results.put(key, record)
+            yield secret, record["results"]
+        return
+
+    hashes = [None if df is None else datasets.persist(df) for df in (ori, syn, control)]
+    with jobs.ProcessPool(min(len(todo), _n_workers())) as pool:
+        futures = {pool.submit(_sweep_worker, hashes, enc["key"], secret, aux_cols, n_attacks): (secret, key)
+                   for secret, aux_cols, key in todo}
+        for future in as_completed(futures):
+            secret, key = futures[future]
+            record, stages = future.result()
+            profiling.extend(stages)
+            results.put(key, record)
+            yield secret, record["results"]
+
+
+def inference_progress(ori, syn, control, n_attacks=1000):
+    """The (secret, results) pairs of a sweep that are already finished, without computing anything."""
+    out = []
+    for secret, _, key in _sweep_keys(ori, syn, control, n_attacks, ori.columns):
+        record = results.get(key)
+        if record is not None:
+            out.append((secret, record["results"]))
+    return out
+
+
+def inference_all(ori, syn, control, n_attacks=1000):
+    """Inference risk of every column, using all the other columns as auxiliary information."""
+    done = dict(inference_sweep(ori, syn, control, n_attacks))
+    return [(secret, done[secret]) for secret in ori.columns]
+
+
+def summary(evaluation_results, confidence_level=stats.CONFIDENCE_LEVEL):
+    """JSON-friendly summary of an EvaluationResults object, with the risk of the naive baseline attack."""
+    risk = stats.risk(evaluation_results, confidence_level)
+    baseline = stats.risk(evaluation_results, confidence_level, baseline=True)
+    return {
+        "risk": risk.value,
+        "ci": list(risk.ci),
+        "baseline_risk": baseline.value,
+        "baseline_ci": list(baseline.ci),
+        "n_attacks": evaluation_results.n_attacks_ori,
+        "n_success": int(evaluation_results.n_success),
+        "n_baseline": int(evaluation_results.n_baseline),
+        "n_control": None if evaluation_results.n_control is None else float(evaluation_results.n_control),
+    }
+
+
+def analyze(ori, syn, control,
+            n_sout_attacks=500,
+            n_link_attacks=2000,
+            n_neighbors=10,
+            aux_cols=DEFAULT_AUX_COLS,
+            n_inference_attacks=1000,
+            sout_mode='univariate',
+            sout_time_budget=None,
+            confidence_level=stats.CONFIDENCE_LEVEL):
+    """Singling out, linkability and inference risk of one synthetic dataset, as in "Analyze All"."""
+    report = {}
+    try:
+        report["singling_out"] = summary(singling_out(ori, syn, control, n_sout_attacks, sout_mode,
+                                                      sout_time_budget)["results"], confidence_level)
+    except RuntimeError as ex:
+        report["singling_out"] = {"error": str(ex)}
+    report["linkability"] = summary(linkability(ori, syn, control, n_link_attacks, aux_cols, n_neighbors)["results"],
+                                    confidence_level)
+    columns = inference_all(ori, syn, control, n_inference_attacks)
+    # The headline inference risk is the one of the last column, like in the app
+    report["inference"] = summary(columns[-1][1], confidence_level)
+    report["inference"]["columns"] = {secret: summary(res, confidence_level) for secret, res in columns}
+    return report
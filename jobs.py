@@ -0,0 +1,231 @@
+# Background evaluation jobs.
+#
+# Evaluations run in a shared process pool instead of the Streamlit script
+# thread, so widget interactions no longer kill a running analysis. A job ID is
+# the results-cache key of the evaluation, which makes identical requests from
+# different sessions share one job and lets a finished result be picked up
+# again after a rerun or a reconnect.
+#
+# The pool is sized so that WORKERS jobs together never use more than MAX_CPUS
+# cores: every worker limits its joblib/BLAS parallelism to JOB_CPUS.
+#
+# With SD_RISK_BROKER set, jobs are queued on the broker (broker.py) instead
+# and run by separate worker processes (worker.py). Either way, every user can
+# have at most USER_QUOTA evaluations queued or running at the same time.
+
+import importlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+import broker
+import datasets
+import profiling
+import results
+
+WORKERS = int(os.environ.get("SD_RISK_WORKERS", "2"))
+MAX_CPUS = int(os.environ.get("SD_RISK_MAX_CPUS", str(os.cpu_count() or 1)))
+QUEUE_SIZE = int(os.environ.get("SD_RISK_QUEUE_SIZE", "16"))
+USER_QUOTA = int(os.environ.get("SD_RISK_USER_QUOTA", "4"))
+JOB_CPUS = max(1, MAX_CPUS // WORKERS)
+
+_executor = None
+_futures = {}
+_owners = {}
+_lock = threading.Lock()
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class ProcessPool(ProcessPoolExecutor):
+    """Spawn-based process pool.
+
+    Streamlit executes app.py as the `__main__` module, and spawned workers
+    import `__main__` on start-up, so every worker would re-run the whole app.
+    With `hide_main` the workers, which are only ever started from `submit`,
+    see an empty `__main__` module instead. Functions defined in `__main__`
+    can then not be submitted.
+    """
+
+    def __init__(self, max_workers, hide_main=False, **kwargs):
+        super().__init__(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"), **kwargs)
+        self._hide_main = hide_main
+
+    def submit(self, *args, **kwargs):
+        if not self._hide_main:
+            return super().submit(*args, **kwargs)
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            return super().submit(*args, **kwargs)
+        finally:
+            sys.modules["__main__"] = main
+
+
+def _init_worker(cpus):
+    global _limits
+    from threadpoolctl import threadpool_limits
+
+    import engine
+
+    _limits = threadpool_limits(limits=cpus)
+    engine.N_JOBS = cpus
+
+
+def resolve(kind):
+    """The evaluation function of a job: `kind` names a function of engine.py, or module.function."""
+    module, _, name = kind.rpartition(".")
+    return getattr(importlib.import_module(module or "engine"), name)
+
+
+def _run(kind, hashes, params, profile_path):
+    # Returns the record together with the stages it went through, see profiling.py
+    with profiling.collect() as stages:
+        with profiling.stage("load_frames"):
+            frames = [None if h is None else datasets.load_hash(h) for h in hashes]
+        if profile_path is None:
+            record = resolve(kind)(*frames, **params)
+        else:
+            with profiling.cprofile(profile_path):
+                record = resolve(kind)(*frames, **params)
+    return {"record": record, "stages": stages}
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPool(WORKERS, hide_main=True, initializer=_init_worker, initargs=(JOB_CPUS,))
+    return _executor
+
+
+def _pending(user=None):
+    return sum(1 for job_id, f in _futures.items() if not f.done() and (user is None or _owners.get(job_id) == user))
+
+
+def _check_quota(pending, user_pending):
+    if pending >= QUEUE_SIZE:
+        raise QueueFull(f"{QUEUE_SIZE} evaluations are already queued. Please try again in a moment.")
+    if user_pending >= USER_QUOTA:
+        raise QueueFull(f"You already have {USER_QUOTA} evaluations running. Please wait for one of them to finish.")
+
+
+def _collect(job_id, future):
+    # Runs in the pool's result thread: keep the record where every session can find it
+    if not future.cancelled() and future.exception() is None:
+        out = future.result()
+        results.put(job_id, out["record"], report=True)
+        profiling.remember_job(job_id, out["stages"])
+        profiling.observe(out["stages"])
+
+
+def submit(kind, frames, params, profile=profiling.PROFILE, user="anonymous"):
+    """Queue `engine.<kind>(*frames, **params)` and return its job ID right away.
+
+    `kind` can also be `module.function` for functions outside engine.py.
+    With `profile`, the job runs under cProfile, see `profile_path`. Raises
+    QueueFull if the queue or the `user`'s quota is full.
+    """
+    job_id = results.make_key(kind, frames, params)
+    queue = broker.connect()
+    if queue is not None:
+        if queue.status(job_id) in ("queued", "running") or results.get(job_id) is not None:
+            return job_id
+        _check_quota(queue.pending(), queue.pending(user))
+        hashes = [None if df is None else datasets.persist(df) for df in frames]
+        queue.enqueue(job_id, user, {"kind": kind, "hashes": hashes, "params": params,
+                                     "profile_path": profile_path(job_id) if profile else None})
+        return job_id
+
+    with _lock:
+        future = _futures.get(job_id)
+        if future is not None and not (future.done() and future.exception() is not None):
+            return job_id
+        if results.get(job_id) is not None:
+            return job_id
+        # Finished jobs are in the results store. Failed ones stay until `result` has
+        # raised their error, otherwise they would turn into unknown jobs
+        for done_id in [k for k, f in _futures.items() if f.done() and not f.cancelled() and f.exception() is None]:
+            del _futures[done_id]
+            _owners.pop(done_id, None)
+        _check_quota(_pending(), _pending(user))
+        hashes = [None if df is None else datasets.persist(df) for df in frames]
+        future = _pool().submit(_run, kind, hashes, params, profile_path(job_id) if profile else None)
+        future.add_done_callback(lambda f: _collect(job_id, f))
+        _futures[job_id] = future
+        _owners[job_id] = user
+    return job_id
+
+
+def profile_path(job_id):
+    """Where the cProfile statistics of a profiled job are saved."""
+    return os.path.join(datasets.CACHE_DIR, "profiles", job_id + ".pstats")
+
+
+def status(job_id):
+    """One of 'queued', 'running', 'done', 'failed' or 'unknown'."""
+    future = _futures.get(job_id)
+    if future is not None:
+        if future.done():
+            return "failed" if future.cancelled() or future.exception() is not None else "done"
+        return "running" if future.running() else "queued"
+    queue = broker.connect()
+    state = None if queue is None else queue.status(job_id)
+    if state in ("queued", "running", "failed"):
+        return state
+    if results.get(job_id) is not None:
+        return "done"
+    return "unknown"
+
+
+def result(job_id):
+    """Result record of a finished job. Re-raises the job's exception if it failed.
+
+    A failed job is forgotten once its exception has been raised here.
+    """
+    future = _futures.get(job_id)
+    if future is not None and future.done():
+        if future.cancelled() or future.exception() is not None:
+            with _lock:
+                if _futures.get(job_id) is future:
+                    del _futures[job_id]
+                    _owners.pop(job_id, None)
+        return future.result()["record"]
+    queue = broker.connect()
+    if queue is not None and queue.status(job_id) == "failed":
+        raise queue.error(job_id)
+    record = results.get(job_id)
+    if record is None:
+        raise KeyError(f"Job {job_id} has no result")
+    return record
+
+
+def stages(job_id):
+    """Stages of a finished job, or None (e.g. served from the cache), see profiling.py."""
+    recorded = profiling.job_stages(job_id)
+    queue = broker.connect()
+    if recorded is None and queue is not None:
+        recorded = queue.stages(job_id)
+    return recorded
+
+
+def wait(job_id, on_update=None, poll=0.5):
+    """Block until a job finishes, calling `on_update(status)` on every poll.
+
+    Raises the job's exception if it failed. Returns None if the job is
+    unknown, e.g. because the server restarted while it ran.
+    """
+    while True:
+        state = status(job_id)
+        if state in ("done", "failed"):
+            return result(job_id)
+        if state == "unknown":
+            return None
+        if on_update is not None:
+            on_update(state)
+        time.sleep(poll)
@@ -0,0 +1,307 @@
+# Multivariate singling out with a vectorized query search.
+#
+# Anonymeter builds every candidate query as a polars expression and evaluates
+# them in batches on the synthetic data, which makes the multivariate attack
+# too slow to use interactively. The queries are the same here (a random
+# synthetic record, `N_COLS` random columns of it, `>=`/`<=` towards the
+# extremes for numerical columns and `==` otherwise) but the search for those
+# that single out a synthetic record runs on bitmasks:
+#
+# - every predicate ("age >= 52") is evaluated once over the column-encoded
+#   synthetic data and cached as a packed bitmask of the rows it matches;
+# - a candidate query is the AND of its predicates' bitmasks, and it singles
+#   out if exactly one bit is set;
+# - combinations of predicates that are known to match several records are
+#   skipped without being evaluated again;
+# - the candidates are drawn in chunks with seeds of their own and checked by
+#   a process pool. The chunks are merged in order, so the queries only depend
+#   on the seed, not on the number of workers. Small synthetic datasets
+#   (below POOL_ROWS records) are searched in-process, where starting the
+#   workers would take longer than the search.
+#
+# The search stops at the time budget, and the risk is then estimated from the
+# queries found so far. Only the queries that were found are turned into
+# polars expressions, which are evaluated on the original and control data as
+# by anonymeter's SinglingOutEvaluator.
+
+import math
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import numpy as np
+import polars as pl
+from anonymeter.evaluators.singling_out_evaluator import (
+    _evaluate_queries,
+    _query_from_record,
+    _random_queries,
+    _safe_column_names,
+    fit_correction_term,
+)
+from anonymeter.stats.confidence import EvaluationResults
+
+import datasets
+import jobs
+import profiling
+
+N_COLS = 3
+CHUNK = 8192
+BATCH = 1024
+MAX_ATTEMPTS = 10000000
+POOL_ROWS = 100000
+# Cached predicate bitmasks are dropped beyond this size
+BANK_MB = 256
+# Bound on the temporary arrays of a batch of candidates or predicates
+BATCH_MB = 64
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_searcher = None
+
+
+def _polars(df):
+    # Same preprocessing as anonymeter's SinglingOutEvaluator
+    return None if df is None else pl.DataFrame(_safe_column_names(df)).unique(maintain_order=True)
+
+
+def _is_numeric(dtype):
+    return dtype.is_numeric() and dtype != pl.Boolean
+
+
+class _Searcher:
+    # The column-encoded synthetic data, the predicate bitmask cache and the
+    # combinations known not to single out
+
+    def __init__(self, p_syn, n_cols):
+        self.n_rows = len(p_syn)
+        self.n_columns = len(p_syn.columns)
+        self.n_cols = n_cols
+        medians = p_syn.median().row(0, named=True)
+        # Every distinct value of a column is one predicate; `pid` maps each cell to it
+        self.pid = np.empty((self.n_rows, self.n_columns), dtype=np.int64)
+        self._columns, self._values, self._offsets = [], [], []
+        offset = 0
+        for j, col in enumerate(p_syn.columns):
+            series = p_syn[col]
+            if _is_numeric(series.dtype):
+                values = series.cast(pl.Float64).to_numpy()
+                uniques, inverse = np.unique(values, return_inverse=True)
+                median = medians.get(col)
+                median = np.nan if median is None else float(median)
+                # Queries look for the more extreme values: >= above the median, <= otherwise
+                self._values.append((values, uniques, uniques > median))
+            else:
+                codes, uniques = series.cast(pl.Utf8).to_pandas().factorize(use_na_sentinel=True)
+                codes = np.where(codes < 0, len(uniques), codes)
+                inverse = codes
+                self._values.append((codes, None, None))
+                uniques = np.arange(len(uniques) + 1)
+            self.pid[:, j] = offset + inverse.reshape(-1)
+            self._columns.append(np.full(len(uniques), j))
+            self._offsets.append(offset)
+            offset += len(uniques)
+        self._column_of = np.concatenate(self._columns) if self._columns else np.empty(0, dtype=np.int64)
+        self._n_bytes = (self.n_rows + 7) // 8
+        self._slot = np.full(offset, -1, dtype=np.int64)
+        self._bank = np.empty((0, self._n_bytes), dtype=np.uint8)
+        self._n_cached = 0
+        # Every predicate of a batch has to fit in the bank at the same time
+        self._capacity = max(n_cols, int(BANK_MB * 2 ** 20) // self._n_bytes)
+        self.batch = max(1, min(BATCH, int(BATCH_MB * 2 ** 20) // self._n_bytes, self._capacity // max(n_cols, 1)))
+        self._mask_group = max(1, min(256, int(BATCH_MB * 2 ** 20) // max(self.n_rows, 1)))
+        self._acc = np.empty((self.batch, self._n_bytes), dtype=np.uint8)
+        self._scratch = np.empty((self.batch, self._n_bytes), dtype=np.uint8)
+        self.non_unique = set()
+
+    def _masks(self, j, local):
+        values, uniques, upper = self._values[j]
+        if uniques is None:
+            matches = values[None, :] == local[:, None]
+        else:
+            v = uniques[local][:, None]
+            col = values[None, :]
+            matches = np.where(np.isnan(v), np.isnan(col), np.where(upper[local][:, None], col >= v, col <= v))
+        return np.packbits(matches, axis=1)
+
+    def _ensure(self, pids):
+        # Compute and cache the bitmasks of the predicates that aren't cached yet
+        missing = pids[self._slot[pids] < 0]
+        if not len(missing):
+            return
+        if self._n_cached + len(missing) > self._capacity:
+            self._slot[:] = -1
+            self._n_cached = 0
+            missing = pids
+        if self._n_cached + len(missing) > len(self._bank):
+            size = min(self._capacity, max(2 * len(self._bank), self._n_cached + len(missing), 256))
+            bank = np.empty((size, self._n_bytes), dtype=np.uint8)
+            bank[:self._n_cached] = self._bank[:self._n_cached]
+            self._bank = bank
+        for j in np.unique(self._column_of[missing]):
+            in_column = missing[self._column_of[missing] == j]
+            for start in range(0, len(in_column), self._mask_group):
+                group = in_column[start:start + self._mask_group]
+                self._bank[self._n_cached:self._n_cached + len(group)] = self._masks(j, group - self._offsets[j])
+                self._slot[group] = np.arange(self._n_cached, self._n_cached + len(group))
+                self._n_cached += len(group)
+
+    def check(self, rows, cols):
+        """Indices of the candidates (rows, sorted columns) that single out a synthetic record, and the number pruned.
+
+        At most `batch` candidates are checked at a time.
+        """
+        pids = self.pid[rows[:, None], cols]
+        keys = list(map(tuple, pids.tolist()))
+        todo = np.array([i for i, key in enumerate(keys) if key not in self.non_unique], dtype=np.int64)
+        if not len(todo):
+            return [], len(keys)
+        sub = pids[todo]
+        self._ensure(np.unique(sub))
+        # AND the predicates' bitmasks into the preallocated accumulator, one column at a time
+        slots = self._slot[sub]
+        acc, scratch = self._acc[:len(todo)], self._scratch[:len(todo)]
+        np.take(self._bank, slots[:, 0], axis=0, out=acc)
+        for k in range(1, slots.shape[1]):
+            np.take(self._bank, slots[:, k], axis=0, out=scratch)
+            np.bitwise_and(acc, scratch, out=acc)
+        counts = np.zeros(len(todo), dtype=np.int64)
+        for start in range(0, self._n_bytes, 4096):
+            counts += _POPCOUNT[acc[:, start:start + 4096]].sum(axis=1, dtype=np.int64)
+        found = []
+        for i, count in zip(todo.tolist(), counts.tolist()):
+            # The record a query comes from always matches it
+            if count == 1:
+                found.append(i)
+            else:
+                self.non_unique.add(keys[i])
+        return found, len(keys) - len(todo)
+
+    def chunk(self, seed, index):
+        """Candidates of chunk `index` that single out: (row, columns, predicates) tuples, and the number pruned."""
+        rng = np.random.default_rng([seed, index])
+        rows = rng.integers(0, self.n_rows, CHUNK)
+        cols = np.sort(np.argsort(rng.random((CHUNK, self.n_columns)), axis=1)[:, :self.n_cols], axis=1)
+        out, pruned = [], 0
+        for start in range(0, CHUNK, self.batch):
+            r, c = rows[start:start + self.batch], cols[start:start + self.batch]
+            found, n_pruned = self.check(r, c)
+            pruned += n_pruned
+            out.extend((int(r[i]), tuple(c[i].tolist()), tuple(self.pid[r[i], c[i]].tolist())) for i in found)
+        return out, pruned
+
+
+def _get_searcher(syn_hash, p_syn, n_cols):
+    # One searcher per process, so its bitmask cache is reused by the next chunks
+    global _searcher
+    if _searcher is None or _searcher[0] != (syn_hash, n_cols):
+        if p_syn is None:
+            p_syn = _polars(datasets.load_hash(syn_hash))
+        _searcher = ((syn_hash, n_cols), _Searcher(p_syn, n_cols))
+    return _searcher[1]
+
+
+def _chunk_worker(syn_hash, n_cols, seed, index):
+    return _get_searcher(syn_hash, None, n_cols).chunk(seed, index)
+
+
+def _chunks(syn, p_syn, n_cols, seed, n_chunks, deadline, n_workers):
+    # Yield the results of the chunks in order, until the deadline
+    syn_hash = datasets.fingerprint(syn)
+    if n_workers == 1 or len(p_syn) < POOL_ROWS:
+        searcher = _get_searcher(syn_hash, p_syn, n_cols)
+        for index in range(n_chunks):
+            if deadline is not None and time.monotonic() > deadline:
+                return
+            yield searcher.chunk(seed, index)
+        return
+
+    datasets.persist(syn)
+    with jobs.ProcessPool(n_workers) as pool:
+        pending = {}
+        try:
+            for index in range(n_chunks):
+                for ahead in range(index, min(n_chunks, index + 2 * n_workers)):
+                    if ahead not in pending:
+                        pending[ahead] = pool.submit(_chunk_worker, syn_hash, n_cols, seed, ahead)
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    yield pending.pop(index).result(timeout=timeout)
+                except FutureTimeout:
+                    return
+        finally:
+            for future in pending.values():
+                future.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def search(syn, n_queries, n_cols=N_COLS, seed=0, max_attempts=MAX_ATTEMPTS, time_budget=None, n_workers=1):
+    """Multivariate queries that single out a synthetic record.
+
+    Returns the polars expressions and statistics of the search. Stops after
+    `n_queries` queries, `max_attempts` candidates or `time_budget` seconds,
+    whichever comes first.
+    """
+    started = time.monotonic()
+    deadline = None if time_budget is None else started + time_budget
+    p_syn = _polars(syn)
+    n_cols = min(n_cols, len(p_syn.columns))
+    found, seen = [], set()
+    n_chunks = math.ceil(max_attempts / CHUNK)
+    n_candidates = n_pruned = 0
+    for chunk, pruned in _chunks(syn, p_syn, n_cols, seed, n_chunks, deadline, n_workers):
+        n_candidates += CHUNK
+        n_pruned += pruned
+        for row, cols, key in chunk:
+            if key not in seen:
+                seen.add(key)
+                found.append((row, cols))
+        if len(found) >= n_queries:
+            break
+    found = found[:n_queries]
+
+    dtypes = dict(p_syn.schema)
+    medians = p_syn.median().row(0, named=True)
+    rng = np.random.default_rng(seed)
+    queries = [_query_from_record(record=p_syn.row(row, named=True), dtypes=dtypes,
+                                  columns=[p_syn.columns[j] for j in cols], medians=medians, rng=rng)
+               for row, cols in found]
+    # The bitmasks and polars must agree on every query
+    queries = [q for q, count in zip(queries, _evaluate_queries(df=p_syn, queries=queries)) if count == 1]
+    return {"queries": queries, "candidates": n_candidates, "pruned": n_pruned,
+            "elapsed": time.monotonic() - started,
+            "complete": len(queries) >= n_queries or n_candidates >= max_attempts}
+
+
+def _n_singled_out(df, queries):
+    return sum(1 for count in _evaluate_queries(df=df, queries=queries) if count == 1)
+
+
+def singling_out(ori, syn, control, n_attacks, n_cols=N_COLS, time_budget=None, seed=0, n_workers=1):
+    """Multivariate singling out risk, as SinglingOutEvaluator.evaluate(mode='multivariate').
+
+    If the time budget runs out first, the risk is estimated from the queries
+    found so far, and `search["complete"]` is False.
+    """
+    with profiling.stage("singling_out_search", rows=n_attacks, cols=ori.shape[1], mode="multivariate") as rec:
+        found = search(syn, n_attacks, n_cols=n_cols, seed=seed, time_budget=time_budget, n_workers=n_workers)
+        rec.update(candidates=found["candidates"], pruned=found["pruned"], found=len(found["queries"]))
+    queries = found["queries"]
+    if not queries:
+        raise RuntimeError("No multivariate singling out query was found within the time budget")
+    # A search cut short by the time budget is an estimate from the queries found so far
+    n = n_attacks if found["complete"] else len(queries)
+
+    with profiling.stage("singling_out", rows=len(ori), cols=ori.shape[1], mode="multivariate"):
+        p_ori, p_syn, p_control = _polars(ori), _polars(syn), _polars(control)
+        n_success = _n_singled_out(p_ori, queries)
+        rng = np.random.default_rng(seed)
+        n_baseline = _n_singled_out(p_ori, _random_queries(df=p_syn, n_queries=n, n_cols=min(n_cols, len(p_syn.columns)), rng=rng))
+        n_control = None
+        if p_control is not None:
+            n_control = _n_singled_out(p_control, queries)
+            # Same correction as anonymeter for a control set of a different size
+            if len(p_control) != len(p_ori):
+                model = fit_correction_term(df=p_control, queries=queries)
+                n_control *= model(len(p_ori)) / model(len(p_control))
+        res = EvaluationResults(n_attacks=n, n_success=n_success, n_baseline=n_baseline, n_control=n_control)
+    return {"results": res,
+            "queries": [str(q) for q in queries],
+            "search": {key: found[key] for key in ("candidates", "pruned", "elapsed", "complete")}}
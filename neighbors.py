@@ -0,0 +1,191 @@
+# Persistent nearest-neighbour index for the linkability attack.
+#
+# The linkability attack looks up the closest synthetic records of every
+# target, once for each group of auxiliary columns. For every encoding (see
+# encoding.py) and column group, the neighbours of a target are computed once,
+# at K_MAX, and stored in a directory next to the encoding. Any smaller number
+# of neighbours is a slice of it, so changing `n_neighbors` or attacking other
+# targets costs only a lookup.
+#
+# Only the targets that were attacked are stored: an attack looks up a few
+# thousand of possibly millions of targets. Every lookup that computes new
+# targets appends a chunk file with their rows and neighbours, so processes
+# sharing an index never write to the same file. Once there are more than
+# MAX_CHUNKS chunks they are compacted into one. The inference attack uses the
+# closest neighbour of the same index, so scenarios that give the attacker the
+# same columns share it.
+#
+# When the synthetic data extends an earlier release with appended rows (see
+# encoding.py), the new index starts from the parent's: the stored neighbours
+# of every computed target are merged with its closest appended rows, so only
+# the new rows are searched.
+
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+import encoding
+import profiling
+
+K_MAX = 20
+MAX_CHUNKS = 64
+
+_indexes = {}
+
+
+def _index_dir(enc, aux_cols):
+    group = hashlib.sha256(json.dumps(list(aux_cols)).encode()).hexdigest()[:16]
+    return os.path.join(encoding._encodings_dir(enc["key"]), "neighbors-" + group)
+
+
+def _width(enc):
+    return min(K_MAX, enc["syn"].shape[0])
+
+
+class _Index:
+    # The stored targets of one column group: their sorted rows and neighbours,
+    # read from the chunk files of the directory
+
+    def __init__(self, path, width):
+        self.path = path
+        self.width = width
+        self.rows = np.empty(0, dtype=np.int64)
+        self.neighbors = np.empty((0, width), dtype=np.int32)
+        self._chunks = set()
+
+    def _merge(self, rows, neighbors):
+        rows = np.concatenate([self.rows, rows])
+        neighbors = np.concatenate([self.neighbors, neighbors])
+        self.rows, first = np.unique(rows, return_index=True)
+        self.neighbors = neighbors[first]
+
+    def refresh(self):
+        """Read the chunks other processes have added since the last refresh."""
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith(".npz"))
+        except FileNotFoundError:
+            return self
+        for name in names:
+            if name in self._chunks:
+                continue
+            try:
+                with np.load(os.path.join(self.path, name)) as chunk:
+                    rows, neighbors = chunk["rows"], chunk["neighbors"]
+            except FileNotFoundError:
+                # Compacted away by another process, its rows are in the compacted chunk
+                continue
+            self._chunks.add(name)
+            if neighbors.shape[1] == self.width:
+                self._merge(rows, neighbors)
+        return self
+
+    def find(self, rows):
+        """Positions of `rows` in the index and whether they are stored at all."""
+        pos = np.minimum(np.searchsorted(self.rows, rows), max(len(self.rows) - 1, 0))
+        found = self.rows[pos] == rows if len(self.rows) else np.zeros(len(rows), dtype=bool)
+        return pos, found
+
+    def _write(self, rows, neighbors):
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{len(self._chunks):08d}-{uuid.uuid4().hex}.npz"
+        tmp = os.path.join(self.path, name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, rows=rows.astype(np.int64), neighbors=neighbors.astype(np.int32))
+        os.replace(tmp, os.path.join(self.path, name))
+        self._chunks.add(name)
+
+    def add(self, rows, neighbors):
+        self._write(rows, neighbors)
+        self._merge(rows, neighbors)
+        if len(self._chunks) > MAX_CHUNKS:
+            old = set(self._chunks)
+            self._write(self.rows, self.neighbors)
+            for name in old:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+                self._chunks.discard(name)
+
+
+def _merge_parent(enc, aux_cols, index):
+    # Fill `index` from the parent encoding's index of the same columns, if there is one
+    if enc.get("parent") is None:
+        return
+    parent = _Index(_index_dir({"key": enc["parent"]}, aux_cols), index.width).refresh()
+    rows = parent.rows
+    if not len(rows):
+        return
+    idx = encoding.column_index(enc, aux_cols)
+    is_num = enc["is_num"][idx]
+    start = enc["parent_rows"]
+    with profiling.stage("neighbors_merge", rows=len(rows), cols=len(idx), appended=enc["syn"].shape[0] - start):
+        queries = np.asarray(enc["targets"][rows][:, idx])
+        old = parent.neighbors
+        old_dist = encoding.distance(queries[:, None, :], np.asarray(enc["syn"][:, idx])[old], is_num)
+        new, new_dist = encoding.kneighbors(queries, np.ascontiguousarray(enc["syn"][start:, idx]), is_num,
+                                            index.width, return_distance=True)
+        merged = np.hstack([old, new + start])
+        order = np.argsort(np.hstack([old_dist, new_dist]), axis=1, kind="stable")[:, :index.width]
+        index.add(rows, np.take_along_axis(merged, order, axis=1))
+
+
+def create(enc, aux_cols):
+    """Open the index of a column group, creating one if needed (from the parent's index if possible)."""
+    path = _index_dir(enc, aux_cols)
+    index = _indexes.get(path)
+    if index is None:
+        index = _Index(path, _width(enc))
+        if not os.path.exists(path):
+            _merge_parent(enc, aux_cols, index)
+            os.makedirs(path, exist_ok=True)
+        _indexes[path] = index
+    return index.refresh()
+
+
+def lookup(enc, aux_cols, rows, n_neighbors):
+    """Indices of the `n_neighbors` closest synthetic records of the target `rows`, closest first.
+
+    `rows` index the encoded targets: the original records followed by the
+    control records.
+    """
+    idx = encoding.column_index(enc, aux_cols)
+    candidates = np.ascontiguousarray(enc["syn"][:, idx])
+    is_num = enc["is_num"][idx]
+    rows = np.asarray(rows)
+    width = _width(enc)
+    if n_neighbors > width:
+        with profiling.stage("neighbors", rows=len(rows), cols=len(idx)):
+            queries = np.asarray(enc["targets"][rows][:, idx])
+            return encoding.kneighbors(queries, candidates, is_num, n_neighbors)
+
+    index = create(enc, aux_cols)
+    _, found = index.find(rows)
+    missing = np.unique(rows[~found])
+    if len(missing):
+        with profiling.stage("neighbors", rows=len(missing), cols=len(idx)):
+            index.add(missing, encoding.kneighbors(np.asarray(enc["targets"][missing][:, idx]), candidates, is_num, width))
+    pos, _ = index.find(rows)
+    return index.neighbors[pos, :n_neighbors]
+
+
+class IndexedKNNPredictor:
+    """Nearest-neighbour inference model on the neighbour index.
+
+    Implements anonymeter's InferencePredictor protocol. The frames given to
+    `predict` must be indexed by target row, see `encoding.target_frames`.
+    """
+
+    def __init__(self, enc, syn, aux_cols, secret):
+        self._enc = enc
+        self._aux_cols = list(aux_cols)
+        self._secret = syn[secret]
+
+    def predict(self, x):
+        idx = lookup(self._enc, self._aux_cols, x.index.to_numpy(), n_neighbors=1)
+        guesses = self._secret.iloc[idx[:, 0]]
+        guesses.index = x.index
+        return guesses
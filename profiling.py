@@ -0,0 +1,239 @@
+# Per-stage timing instrumentation.
+#
+# Every expensive stage (loading a dataset, encoding, the singling out,
+# linkability and per-column inference attacks, ...) runs inside `stage()`,
+# which measures its wall time, CPU time and memory. The memory of a stage is
+# the largest RSS of the process sampled while it runs (every SAMPLE_SECONDS,
+# and at its start and end) and how far that is above the RSS at its start.
+# The process-lifetime peak (ru_maxrss) would report the largest earlier job
+# of a long-lived app or worker process for every later stage.
+#
+# Stages that run in worker processes are collected with `collect()` and
+# travel back to the app process with the job's result. Only the app (or CLI)
+# process observes them: it writes one JSON log line per stage, keeps the
+# totals for the Prometheus endpoint (SD_RISK_METRICS_PORT) and remembers the
+# stages of recent jobs for the app's performance expander.
+#
+# With SD_RISK_PROFILE=1 every job also runs under cProfile and leaves a .pstats
+# file under CACHE_DIR/profiles (see jobs.py). Stage records carry the worker's pid, which can
+# be given to `py-spy record --pid` instead.
+
+import cProfile
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = os.environ.get("SD_RISK_METRICS_PORT")
+PROFILE = os.environ.get("SD_RISK_PROFILE") == "1"
+JOB_SLOTS = 256
+SAMPLE_SECONDS = 0.05
+
+logger = logging.getLogger("sd_risk")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get("SD_RISK_LOG_LEVEL", "INFO"))
+    logger.propagate = False
+
+_local = threading.local()
+_lock = threading.Lock()
+_totals = {}
+_jobs = OrderedDict()
+_server = None
+_active = {}
+_sampler = None
+
+
+def _process_peak_rss_mb():
+    # Peak over the whole life of the process. ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _rss_mb():
+    # Current RSS. Without /proc (e.g. macOS) only the process peak is available
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return _process_peak_rss_mb()
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def _sample():
+    # Raise the peak of every running stage of this process to the current RSS
+    while True:
+        time.sleep(SAMPLE_SECONDS)
+        with _lock:
+            if not _active:
+                continue
+            rss = _rss_mb()
+            for rec in _active.values():
+                rec["peak_rss_mb"] = max(rec["peak_rss_mb"], rss)
+
+
+def _start_sampler():
+    global _sampler
+    with _lock:
+        if _sampler is not None and _sampler[0] == os.getpid():
+            return
+        thread = threading.Thread(target=_sample, daemon=True)
+        _sampler = (os.getpid(), thread)
+    thread.start()
+
+
+def _collectors():
+    if not hasattr(_local, "collectors"):
+        _local.collectors = []
+    return _local.collectors
+
+
+def _is_observer():
+    return multiprocessing.parent_process() is None
+
+
+def log_event(event, **fields):
+    """Write one structured (JSON) log line."""
+    logger.info(json.dumps({"event": event, "time": time.time(), **fields}, default=str))
+
+
+def observe(stages):
+    """Log finished stages and add them to the metrics."""
+    with _lock:
+        for rec in stages:
+            totals = _totals.setdefault(rec["stage"], {"runs": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_mb": 0.0,
+                                                       "rss_increase_mb": 0.0})
+            totals["runs"] += 1
+            totals["wall"] += rec["wall"]
+            totals["cpu"] += rec["cpu"]
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], rec["peak_rss_mb"])
+            totals["rss_increase_mb"] = max(totals["rss_increase_mb"], rec["rss_increase_mb"])
+    for rec in stages:
+        log_event("stage", **rec)
+
+
+def extend(stages):
+    """Hand finished stages, e.g. recorded in another process, to the active collectors and the observer."""
+    for collected in _collectors():
+        collected.extend(stages)
+    if _is_observer():
+        observe(stages)
+
+
+@contextmanager
+def collect():
+    """Collect the stages that finish in this thread inside the block."""
+    stages = []
+    _collectors().append(stages)
+    try:
+        yield stages
+    finally:
+        _collectors().remove(stages)
+
+
+@contextmanager
+def stage(name, rows=None, cols=None, **labels):
+    """Measure the wall time, CPU time and memory of the block.
+
+    `peak_rss_mb` is the largest RSS sampled during the block and
+    `rss_increase_mb` how far it is above the RSS at the start. Yields the
+    record, so fields that are only known at the end (e.g. the number of
+    rows) can still be filled in.
+    """
+    _start_sampler()
+    start_rss = _rss_mb()
+    rec = {"stage": name, **labels, "rows": rows, "cols": cols}
+    memory = {"peak_rss_mb": start_rss}
+    with _lock:
+        _active[id(memory)] = memory
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield rec
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        with _lock:
+            del _active[id(memory)]
+        peak = max(memory["peak_rss_mb"], _rss_mb())
+        rec.update(wall=wall,
+                   cpu=cpu,
+                   peak_rss_mb=peak,
+                   rss_increase_mb=peak - start_rss,
+                   pid=os.getpid())
+        extend([rec])
+
+
+def remember_job(job_id, stages):
+    with _lock:
+        _jobs[job_id] = stages
+        _jobs.move_to_end(job_id)
+        while len(_jobs) > JOB_SLOTS:
+            _jobs.popitem(last=False)
+
+
+def job_stages(job_id):
+    """Stages of a job that finished in this process, or None (e.g. served from the cache)."""
+    return _jobs.get(job_id)
+
+
+@contextmanager
+def cprofile(path):
+    """Run the block under cProfile and save the statistics to `path` (.pstats, e.g. for snakeviz)."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profiler.dump_stats(path)
+
+
+def metrics_text():
+    """The stage totals in the Prometheus text exposition format."""
+    lines = []
+    series = [("sd_risk_stage_runs_total", "counter", "runs", "Finished runs of the stage"),
+              ("sd_risk_stage_seconds_total", "counter", "wall", "Wall time spent in the stage"),
+              ("sd_risk_stage_cpu_seconds_total", "counter", "cpu", "CPU time spent in the stage"),
+              ("sd_risk_stage_peak_rss_megabytes", "gauge", "peak_rss_mb", "Largest RSS sampled during a run of the stage"),
+              ("sd_risk_stage_rss_increase_megabytes", "gauge", "rss_increase_mb",
+               "Largest growth of the RSS during a run of the stage over its start")]
+    with _lock:
+        totals = {name: dict(values) for name, values in _totals.items()}
+    for metric, kind, field, help_text in series:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, values in sorted(totals.items()):
+            lines.append(f'{metric}{{stage="{name}"}} {values[field]}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port=METRICS_PORT):
+    """Serve /metrics on `port` from a background thread. Does nothing without a port or if already serving."""
+    global _server
+    with _lock:
+        if port is None or _server is not None:
+            return
+        _server = ThreadingHTTPServer(("", int(port)), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
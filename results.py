@@ -0,0 +1,140 @@
+# Memoized evaluation results.
+#
+# A result is keyed by the fingerprints of the datasets it was computed on plus
+# the full evaluator configuration. Results live in a bounded in-process LRU
+# and in a bounded on-disk tier under CACHE_DIR/results, so repeated clicks,
+# other tabs and other processes can reuse a result instead of re-attacking.
+#
+# The records of finished jobs are also kept in the report store
+# (SD_RISK_REPORTS_DIR, by default CACHE_DIR/reports), which has its own, larger
+# bound so that intermediate results never push reports out. With the UI and
+# the workers sharing that directory, a report computed for one user is served
+# to every other user asking for the same evaluation.
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from importlib.metadata import PackageNotFoundError, version
+
+import datasets
+
+MEMORY_SLOTS = int(os.environ.get("SD_RISK_MEMORY_RESULTS", "64"))
+DISK_BYTES = int(os.environ.get("SD_RISK_DISK_RESULTS_MB", "256")) * 1024 * 1024
+REPORTS_DIR = os.environ.get("SD_RISK_REPORTS_DIR")
+REPORTS_BYTES = int(os.environ.get("SD_RISK_REPORTS_MB", "1024")) * 1024 * 1024
+
+try:
+    ANONYMETER_VERSION = version("anonymeter")
+except PackageNotFoundError:
+    ANONYMETER_VERSION = "unknown"
+
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+def _results_dir():
+    path = os.path.join(datasets.CACHE_DIR, "results")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _reports_dir():
+    path = REPORTS_DIR or os.path.join(datasets.CACHE_DIR, "reports")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _path(key):
+    return os.path.join(_results_dir(), key + ".pkl")
+
+
+def _report_path(key):
+    return os.path.join(_reports_dir(), key + ".pkl")
+
+
+def make_key(kind, frames, params):
+    """Cache key for an evaluation of `kind` on `frames` with `params`."""
+    payload = {
+        "kind": kind,
+        "datasets": [None if df is None else datasets.fingerprint(df) for df in frames],
+        "params": params,
+        "anonymeter": ANONYMETER_VERSION,
+    }
+    blob = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(blob).hexdigest()
+
+
+def _remember(key, record):
+    with _lock:
+        _results[key] = record
+        _results.move_to_end(key)
+        while len(_results) > MEMORY_SLOTS:
+            _results.popitem(last=False)
+
+
+def _evict(directory, limit):
+    # Drop the least recently used files until the tier fits in `limit` bytes
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def get(key):
+    """Return a cached result record, or None."""
+    with _lock:
+        record = _results.get(key)
+        if record is not None:
+            _results.move_to_end(key)
+            return record
+    for path in (_path(key), _report_path(key)):
+        try:
+            with open(path, "rb") as f:
+                record = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            continue
+        _remember(key, record)
+        return record
+    return None
+
+
+def put(key, record, report=False):
+    """Cache a result record. With `report`, it goes to the report store instead of the results tier."""
+    _remember(key, record)
+    path = _report_path(key) if report else _path(key)
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, "wb") as f:
+        pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    if report:
+        _evict(_reports_dir(), REPORTS_BYTES)
+    else:
+        _evict(_results_dir(), DISK_BYTES)
+
+
+def cached(kind, frames, params, compute):
+    """Return the result for (kind, frames, params), running `compute()` on a miss."""
+    key = make_key(kind, frames, params)
+    record = get(key)
+    if record is None:
+        record = compute()
+        put(key, record)
+    return record
+
@@ -0,0 +1,120 @@
+# "Fast estimate" mode: evaluate with just enough attacks for the target CI.
+#
+# The attacks themselves are what make an evaluation slow, and the width of
+# the confidence interval only depends on how many of them are run. A fast
+# estimate therefore attacks the full datasets, starting with a small pilot
+# round. The Wilson interval of the pilot's success rates gives the number of
+# attacks at which the CI reaches the target width, and the next round runs
+# that many. Rounds never go beyond MAX_FRACTION of the requested attacks.
+#
+# The data are never subsampled: singling out and linkability succeed much more
+# often on a few thousand rows than on the full table, so a risk measured on a
+# row sample is biased. With the full data the estimate only differs from a
+# full run by the attack noise its CI accounts for. If the full run has been
+# computed before, the difference between the two is reported as well.
+
+import numpy as np
+from anonymeter.stats.confidence import EvaluationResults
+
+import jobs
+import results
+import stats
+
+START_ATTACKS = 100
+MAX_FRACTION = 0.5
+
+
+def _evaluation_results(kind, record):
+    if kind == "inference_all":
+        # The headline inference risk is the one of the last column, like in the app
+        return record[-1][1]
+    return record["results"]
+
+
+def _attacks_param(kind):
+    # Adaptive evaluations take their largest budget instead of a fixed number of attacks
+    return "max_attacks" if kind.startswith("adaptive.") else "n_attacks"
+
+
+def _full_attacks(kind, ori, control, params):
+    n = params.get(_attacks_param(kind), 1000)
+    if kind.endswith("linkability"):
+        n = min(n, len(ori), len(ori) if control is None else len(control))
+    return n
+
+
+def _run(kind, ori, syn, control, params, n_attacks):
+    return jobs.resolve(kind)(ori, syn, control, **{**params, _attacks_param(kind): n_attacks})
+
+
+def attacks_for_width(res, target_width, limit):
+    """The smallest number of attacks, up to `limit`, whose Wilson CI is at most `target_width` wide.
+
+    The success rates are taken from `res` and the width is the one before
+    the CI is clipped to [0, 1], see `stats.width`. Returns `limit` if even
+    that many attacks don't reach the target.
+    """
+    c = stats.counts(res)
+    n = np.arange(1, limit + 1, dtype=float)
+    n_control = None if c["n_control"] is None else c["n_control"] * n / c["n_attacks_control"]
+    # Unclipped: the clipped CI of a risk near 0 is narrower than the uncertainty of the estimate
+    _, lower, upper = stats.rates(n, c["n_success"] * n / c["n_attacks"], n, n_control, clip=False)
+    narrow = np.flatnonzero(upper - lower <= target_width)
+    return int(n[narrow[0]]) if len(narrow) else limit
+
+
+def _projected(res, n_attacks):
+    # The CI a run with `n_attacks` attacks would have at the same success rates
+    def scaled(n, total):
+        return None if n is None else int(round(n * n_attacks / total))
+    return EvaluationResults(n_attacks=n_attacks,
+                             n_success=scaled(res.n_success, res.n_attacks_ori),
+                             n_baseline=scaled(res.n_baseline, res.n_attacks_baseline),
+                             n_control=scaled(res.n_control, res.n_attacks_control)).risk()
+
+
+def fast_estimate(ori, syn, control, kind, params, target_width, start_attacks=START_ATTACKS):
+    """Run the evaluation `kind` (see `jobs.resolve`) with as few attacks as the `target_width` of the CI needs.
+
+    Returns the record of the last round together with the attacks, risk and
+    CI width of every round, the CI projected for the full number of attacks
+    and, if it has been computed before, the risk and CI of the full run and
+    the difference of the estimate from it.
+    """
+    n_full = _full_attacks(kind, ori, control, params)
+    cap = max(1, min(n_full - 1, int(MAX_FRACTION * n_full)))
+    rounds = []
+    n = min(start_attacks, cap)
+    while True:
+        try:
+            record = _run(kind, ori, syn, control, params, n)
+        except RuntimeError:
+            # e.g. too few singling out queries to correct for the control size
+            if n >= cap:
+                raise
+            n = min(cap, 2 * n)
+            continue
+        res = _evaluation_results(kind, record)
+        risk = res.risk()
+        rounds.append({"n_attacks": res.n_attacks_ori, "risk": risk.value, "ci": list(risk.ci),
+                       "width": stats.width(res)})
+        if rounds[-1]["width"] <= target_width or n >= cap:
+            break
+        needed = attacks_for_width(res, target_width, cap)
+        # A noisy pilot can underestimate the attacks needed: always grow
+        n = min(cap, needed if needed > n else 2 * n)
+
+    projected = _projected(res, n_full)
+    # A full run submitted from the app is stored under its job ID
+    full = results.get(results.make_key(kind, (ori, syn, control), params))
+    full_risk = None if full is None else _evaluation_results(kind, full).risk()
+    return {
+        "record": record,
+        "rounds": rounds,
+        "n_full": n_full,
+        "target_width": target_width,
+        "projected_ci": list(projected.ci),
+        "full_risk": None if full_risk is None else full_risk.value,
+        "full_ci": None if full_risk is None else list(full_risk.ci),
+        "bias": None if full_risk is None else risk.value - full_risk.value,
+    }
@@ -0,0 +1,205 @@
+# Attacker-knowledge scenario sweeps.
+#
+# A scenario is one linkability or inference attack with a given split of the
+# auxiliary columns. A sweep runs many of them against the same datasets and
+# returns a risk matrix: one row per scenario, one column per secret (or a
+# single "linkability" column).
+#
+# Scenarios share all the expensive work. The datasets are encoded once, and
+# the neighbour index of every column group (see neighbors.py) is reused by
+# every scenario that gives the attacker the same columns.
+#
+# The UI builds the scenario list on every render, so the evaluators (engine,
+# stats) are only imported by the functions that run or score scenarios.
+
+import itertools
+import math
+from concurrent.futures import as_completed
+
+import numpy as np
+import pandas as pd
+
+import datasets
+import encoding
+import jobs
+import neighbors
+import profiling
+import results
+
+MAX_SCENARIOS = 64
+# Above this many k-subsets, generate() draws random ones instead of listing them all
+MAX_ENUMERATED = 100000
+
+
+def _label(cols):
+    return ", ".join(cols)
+
+
+def _sample(scenarios, limit, seed):
+    # Keep a reproducible subset if the generator produced too many scenarios
+    if len(scenarios) <= limit:
+        return scenarios
+    keep = np.sort(np.random.default_rng(seed).choice(len(scenarios), size=limit, replace=False))
+    return [scenarios[i] for i in keep]
+
+
+def _combinations(items, k, limit, rng, keep=lambda combo: True):
+    # All k-subsets of `items` that pass `keep`, in itertools order. If there are too
+    # many to list, `limit` distinct random ones, so that wide tables never build
+    # millions of scenarios just to keep a few of them
+    if math.comb(len(items), k) <= MAX_ENUMERATED:
+        return [combo for combo in itertools.combinations(items, k) if keep(combo)]
+    found = set()
+    while len(found) < limit:
+        combo = tuple(np.sort(rng.choice(len(items), size=k, replace=False)))
+        if keep(tuple(items[i] for i in combo)):
+            found.add(combo)
+    return [tuple(items[i] for i in combo) for combo in sorted(found)]
+
+
+def linkability_splits(splits):
+    """Scenarios for explicit (columns A, columns B) splits."""
+    return [{"kind": "linkability", "aux_cols": [list(a), list(b)], "label": _label(a) + " | " + _label(b)}
+            for a, b in splits]
+
+
+def generate(kind, columns, method, k=1, split=None, secrets=None, limit=MAX_SCENARIOS, seed=0):
+    """Generate scenarios with `method` 'k_subsets' or 'leave_one_out'.
+
+    Linkability, k_subsets: every k columns against the remaining ones.
+    Linkability, leave_one_out: `split` without one of its columns at a time.
+    Inference, k_subsets: every secret attacked with every k other columns.
+    Inference, leave_one_out: every secret attacked with all the other columns but one.
+
+    At most `limit` scenarios are kept, a reproducible random subset if there are more.
+    """
+    columns = list(columns)
+    rng = np.random.default_rng(seed)
+    out = []
+    if kind == "linkability" and method == "k_subsets":
+        def rest(a):
+            return [col for col in columns if col not in a]
+
+        def keep(a):
+            # Both groups non-empty, and an even split only once
+            b = rest(a)
+            return bool(b) and (len(a) != len(b) or list(a) < b)
+
+        out.extend(linkability_splits([(a, rest(a)) for a in _combinations(columns, k, limit, rng, keep)]))
+    elif kind == "linkability" and method == "leave_one_out":
+        a, b = split
+        for col in list(a) + list(b):
+            left = [[c for c in group if c != col] for group in (a, b)]
+            if all(left):
+                out.append({"kind": "linkability", "aux_cols": left, "label": "without " + col})
+    elif kind == "inference":
+        for secret in (columns if secrets is None else secrets):
+            others = [col for col in columns if col != secret]
+            if method == "k_subsets":
+                groups = [(list(aux), _label(aux)) for aux in _combinations(others, k, limit, rng)]
+            elif method == "leave_one_out":
+                groups = [([c for c in others if c != col], "without " + col) for col in others]
+            else:
+                raise ValueError(f"Unknown scenario method {method}")
+            out.extend({"kind": "inference", "aux_cols": aux, "secret": secret, "label": label}
+                       for aux, label in groups)
+    else:
+        raise ValueError(f"Unknown scenario kind or method: {kind}, {method}")
+    return _sample(out, limit, seed)
+
+
+def _key(ori, syn, control, scenario, params):
+    import engine
+
+    if scenario["kind"] == "linkability":
+        return results.make_key("linkability", (ori, syn, control),
+                                engine._linkability_params(params["n_link_attacks"], scenario["aux_cols"],
+                                                           params["n_neighbors"], 0))
+    return results.make_key("inference", (ori, syn, control),
+                            engine._inference_params(scenario["secret"], scenario["aux_cols"],
+                                                     params["n_inference_attacks"]))
+
+
+def evaluate(ori, syn, control, scenario, n_link_attacks=2000, n_neighbors=10, n_inference_attacks=1000):
+    """Run one scenario. Returns its EvaluationResults."""
+    import engine
+
+    if scenario["kind"] == "linkability":
+        record = engine.linkability(ori, syn, control, n_link_attacks, scenario["aux_cols"], n_neighbors)
+    else:
+        record = engine.inference(ori, syn, control, scenario["secret"], scenario["aux_cols"], n_inference_attacks)
+    return record["results"]
+
+
+def _worker(hashes, scenario, params):
+    ori, syn, control = [None if h is None else datasets.load_hash(h) for h in hashes]
+    with profiling.collect() as stages:
+        res = evaluate(ori, syn, control, scenario, **params)
+    return res, stages
+
+
+def _params(n_link_attacks, n_neighbors, n_inference_attacks):
+    return {"n_link_attacks": n_link_attacks, "n_neighbors": n_neighbors, "n_inference_attacks": n_inference_attacks}
+
+
+def sweep(ori, syn, control, scenarios, n_link_attacks=2000, n_neighbors=10, n_inference_attacks=1000):
+    """Yield (position, results) for every scenario as soon as it is finished."""
+    import engine
+
+    params = _params(n_link_attacks, n_neighbors, n_inference_attacks)
+    todo = []
+    for i, scenario in enumerate(scenarios):
+        record = results.get(_key(ori, syn, control, scenario, params))
+        if record is None:
+            todo.append(i)
+        else:
+            yield i, record["results"]
+    if not todo:
+        return
+
+    # Encode and create the shared neighbour indexes up front, so that the workers don't race for them
+    enc = encoding.encode(ori, syn, control)
+    for i in todo:
+        groups = scenarios[i]["aux_cols"] if scenarios[i]["kind"] == "linkability" else [scenarios[i]["aux_cols"]]
+        for group in groups:
+            neighbors.create(enc, group)
+
+    if engine._n_workers() == 1 or len(todo) == 1:
+        for i in todo:
+            yield i, evaluate(ori, syn, control, scenarios[i], **params)
+        return
+
+    hashes = [None if df is None else datasets.persist(df) for df in (ori, syn, control)]
+    with jobs.ProcessPool(min(len(todo), engine._n_workers())) as pool:
+        futures = {pool.submit(_worker, hashes, scenarios[i], params): i for i in todo}
+        for future in as_completed(futures):
+            res, stages = future.result()
+            profiling.extend(stages)
+            yield futures[future], res
+
+
+def progress(ori, syn, control, scenarios, n_link_attacks=2000, n_neighbors=10, n_inference_attacks=1000):
+    """Number of scenarios of a sweep that are already finished, without computing anything."""
+    params = _params(n_link_attacks, n_neighbors, n_inference_attacks)
+    return sum(1 for scenario in scenarios if results.get(_key(ori, syn, control, scenario, params)) is not None)
+
+
+def sweep_all(ori, syn, control, scenarios, n_link_attacks=2000, n_neighbors=10, n_inference_attacks=1000):
+    """Results of every scenario, in order."""
+    done = dict(sweep(ori, syn, control, scenarios, n_link_attacks, n_neighbors, n_inference_attacks))
+    return {"scenarios": scenarios, "results": [done[i] for i in range(len(scenarios))]}
+
+
+def risk_matrix(record, confidence_level=None):
+    """Risk of every scenario: one row per scenario label, one column per secret (or "linkability")."""
+    import stats
+
+    if confidence_level is None:
+        confidence_level = stats.CONFIDENCE_LEVEL
+    rows = [{"scenario": scenario["label"],
+             "target": scenario.get("secret", "linkability"),
+             "risk": stats.risk(res, confidence_level).value}
+            for scenario, res in zip(record["scenarios"], record["results"])]
+    matrix = pd.DataFrame(rows).pivot_table(index="scenario", columns="target", values="risk", sort=False)
+    matrix.columns.name = None
+    return matrix
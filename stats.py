@@ -0,0 +1,111 @@
+# Risk statistics recomputed from the stored attack counts.
+#
+# Every cached EvaluationResults keeps the raw outcome of its attacks: the
+# number of attacks and of successes against the original, control and
+# baseline targets. Everything the UI shows (risk, CI at any confidence level,
+# bootstrap distributions, scores) is derived from these counts here, with
+# numpy, so changing the confidence level never re-runs an attack.
+#
+# `risk` follows anonymeter's formulas exactly: Wilson score rates, the
+# residual success over the control rate with propagated errors, clipped to
+# [0, 1].
+
+import numpy as np
+from anonymeter.stats.confidence import PrivacyRisk
+from scipy.stats import norm
+
+CONFIDENCE_LEVEL = 0.95
+N_RESAMPLES = 10000
+
+
+def counts(res):
+    """The raw counts of an EvaluationResults as a dict of floats (n_control is None without control data)."""
+    return {
+        "n_attacks": float(res.n_attacks_ori),
+        "n_success": float(res.n_success),
+        "n_attacks_baseline": float(res.n_attacks_baseline),
+        "n_baseline": float(res.n_baseline),
+        "n_attacks_control": float(res.n_attacks_control),
+        "n_control": None if res.n_control is None else float(res.n_control),
+    }
+
+
+def _wilson(n_total, n_success, z):
+    z2 = z * z
+    denominator = n_total + z2
+    rate = (n_success + 0.5 * z2) / denominator
+    error = (z / denominator) * np.sqrt(n_success * (n_total - n_success) / n_total + 0.25 * z2)
+    return rate, error
+
+
+def rates(n_attacks, n_success, n_attacks_control=None, n_control=None, confidence_level=CONFIDENCE_LEVEL,
+          clip=True):
+    """Risk point estimates and CI bounds, as arrays broadcast over all the arguments.
+
+    Returns (value, lower, upper). Without control counts the risk is the
+    attack success rate, otherwise its residual over the control success rate.
+    With `clip=False` the bounds are value -/+ error, without clipping them to
+    [0, 1], so `upper - lower` is the real width of the interval.
+    """
+    z = norm.ppf(0.5 * (1.0 + np.asarray(confidence_level, dtype=float)))
+    value, error = _wilson(np.asarray(n_attacks, dtype=float), np.asarray(n_success, dtype=float), z)
+    if n_control is not None:
+        control, control_error = _wilson(np.asarray(n_attacks_control, dtype=float), np.asarray(n_control, dtype=float), z)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            residual = (value - control) / (1.0 - control)
+            error = np.sqrt((error / np.abs(1 - control)) ** 2 + (control_error * (value - 1) / (1 - control) ** 2) ** 2)
+        value = residual
+    if not clip:
+        return value, value - error, value + error
+    return np.clip(value, 0.0, 1.0), np.clip(value - error, 0.0, 1.0), np.clip(value + error, 0.0, 1.0)
+
+
+def risk(res, confidence_level=CONFIDENCE_LEVEL, baseline=False):
+    """PrivacyRisk of an EvaluationResults at any confidence level, same as `res.risk()` at 0.95."""
+    c = counts(res)
+    if baseline:
+        value, lower, upper = rates(c["n_attacks_baseline"], c["n_baseline"], confidence_level=confidence_level)
+    else:
+        value, lower, upper = rates(c["n_attacks"], c["n_success"], c["n_attacks_control"], c["n_control"],
+                                    confidence_level=confidence_level)
+    return PrivacyRisk(value=float(value), ci=(float(lower), float(upper)))
+
+
+def width(res, confidence_level=CONFIDENCE_LEVEL):
+    """Width of the risk CI of an EvaluationResults before clipping, i.e. twice the error of the risk.
+
+    The clipped CI of a residual risk near 0 looks much narrower than it is,
+    so this is the width to compare with a target precision.
+    """
+    c = counts(res)
+    _, lower, upper = rates(c["n_attacks"], c["n_success"], c["n_attacks_control"], c["n_control"],
+                            confidence_level=confidence_level, clip=False)
+    return float(upper - lower)
+
+
+def bootstrap(res, n_resamples=N_RESAMPLES, seed=0, confidence_level=CONFIDENCE_LEVEL):
+    """Bootstrap distribution of the risk point estimate, resampling the attack outcomes.
+
+    Returns the resampled risks and their percentile interval at `confidence_level`.
+    """
+    c = counts(res)
+    rng = np.random.default_rng(seed)
+    n = int(c["n_attacks"])
+    success = rng.binomial(n, c["n_success"] / n, size=n_resamples)
+    n_control = None
+    if c["n_control"] is not None:
+        m = int(c["n_attacks_control"])
+        # The control count can be fractional after the size correction of singling out
+        n_control = rng.binomial(m, min(1.0, c["n_control"] / m), size=n_resamples)
+    risks = rates(n, success, c["n_attacks_control"], n_control, confidence_level=confidence_level)[0]
+    tail = 50 * (1 - confidence_level)
+    return {"risks": risks, "ci": tuple(float(q) for q in np.percentile(risks, [tail, 100 - tail]))}
+
+
+def scores(privacy_risk):
+    """Score (100 - risk in %) and the scores at the two ends of the CI."""
+    return {
+        "score": 100 - 100 * privacy_risk.value,
+        "ci_from": 100 * (1 - privacy_risk.ci[0]),
+        "ci_to": 100 * (1 - privacy_risk.ci[1]),
+    }
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datasets
+import multivariate
+import neighbors
+import results
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # A fresh cache directory per test, and no dataset, result or index left in memory by another one
+    path = tmp_path / "cache"
+    monkeypatch.setattr(datasets, "CACHE_DIR", str(path))
+    monkeypatch.setattr(datasets, "_frames", type(datasets._frames)())
+    monkeypatch.setattr(results, "REPORTS_DIR", None)
+    monkeypatch.setattr(results, "_results", type(results._results)())
+    monkeypatch.setattr(neighbors, "_indexes", {})
+    monkeypatch.setattr(multivariate, "_searcher", None)
+    return path
+
+
+def make_table(n_rows, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "age": rng.integers(17, 90, n_rows),
+        "hours": rng.integers(1, 80, n_rows),
+        "income": rng.lognormal(10, 1, n_rows).round(2),
+        "job": pd.Categorical(rng.choice(list("abcdef"), size=n_rows)),
+        "city": pd.Categorical(np.char.add("c", rng.integers(0, 50, n_rows).astype(str))),
+    })
+
+
+def make_synthetic(ori, seed, noise=0.2):
+    # Resampled original records, some of them with the numeric values of other records
+    rng = np.random.default_rng(seed)
+    syn = ori.iloc[rng.integers(0, len(ori), len(ori))].reset_index(drop=True)
+    for col in ["age", "income"]:
+        replace = rng.random(len(syn)) < noise
+        syn.loc[replace, col] = ori[col].to_numpy()[rng.integers(0, len(ori), replace.sum())]
+    return syn
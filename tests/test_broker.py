@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+import broker
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def queue():
+    return broker.RedisBroker("redis://fake", client=fakeredis.FakeRedis())
+
+
+def make_stale(queue, job_id):
+    queue._redis.hset(queue._key("job", job_id), "heartbeat", time.time() - 10 * broker.STALE_SECONDS)
+
+
+def test_stale_job_is_requeued_once_by_concurrent_sweeps(queue):
+    queue.enqueue("job", "alice", {"kind": "linkability"})
+    assert queue.claim("w1")[0] == "job"
+    make_stale(queue, "job")
+
+    queue.requeue_stale()
+    queue.requeue_stale()
+    assert queue.status("job") == "queued"
+    assert queue._redis.lrange(queue._key("queue", "alice"), 0, -1) == [b"job"]
+    assert queue.pending("alice") == 1
+
+
+def test_acked_job_is_not_requeued(queue):
+    queue.enqueue("job", "alice", {"kind": "linkability"})
+    queue.claim("w1")
+    make_stale(queue, "job")
+    queue.complete("job", [])
+
+    queue.requeue_stale()
+    assert queue.status("job") == "done"
+    assert queue._redis.llen(queue._key("queue", "alice")) == 0
+
+
+def test_job_fails_after_max_attempts(queue):
+    queue.enqueue("job", "alice", {"kind": "linkability"})
+    for _ in range(broker.MAX_ATTEMPTS):
+        queue.claim("w1")
+        make_stale(queue, "job")
+        queue.requeue_stale()
+    assert queue.status("job") == "failed"
+    assert "lost by its worker" in str(queue.error("job"))
+    assert queue.pending() == 0
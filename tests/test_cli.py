@@ -0,0 +1,39 @@
+import json
+import os
+
+import pytest
+
+import cli
+
+from conftest import make_table
+
+
+def write_table(path, n_rows, seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    make_table(n_rows, seed).to_csv(path, index=False)
+    return str(path)
+
+
+def test_same_named_candidates_get_their_own_reports(tmp_path):
+    ori = write_table(tmp_path / "ori.csv", 400, 0)
+    control = write_table(tmp_path / "control.csv", 400, 1)
+    run_a = write_table(tmp_path / "runA" / "syn.csv", 400, 2)
+    run_b = write_table(tmp_path / "runB" / "syn.csv", 400, 3)
+    out = tmp_path / "reports"
+
+    cli.main(["--ori", ori, "--control", control, "--syn", run_a, run_b, "--out", str(out),
+              "--sout-attacks", "50", "--link-attacks", "100", "--inference-attacks", "100",
+              "--aux-cols", "age,job", "hours,city"])
+
+    reports = {name: json.loads((out / name / "syn.json").read_text()) for name in ["runA", "runB"]}
+    assert reports["runA"]["syn"] == run_a
+    assert reports["runB"]["syn"] == run_b
+    linkability = reports["runA"]["linkability"]
+    assert 0 <= linkability["baseline_ci"][0] <= linkability["baseline_risk"] <= linkability["baseline_ci"][1] <= 1
+
+
+def test_report_names_fail_on_collisions():
+    assert cli.report_names(["a/syn.csv", "b/syn.csv"]) == {"a/syn.csv": "a/syn", "b/syn.csv": "b/syn"}
+    assert cli.report_names(["runs/x.csv", "runs/y.csv"]) == {"runs/x.csv": "x", "runs/y.csv": "y"}
+    with pytest.raises(ValueError, match="syn.json"):
+        cli.report_names(["runs/syn.csv", "runs/syn.tsv"])
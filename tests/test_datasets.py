@@ -0,0 +1,64 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+import datasets
+
+
+def test_ingest_round_trip_keeps_values():
+    csv = ("year,small,wide,neg,score,label\n"
+           "1990,200,-5,-129,0.5,a\n"
+           "2020,250,70000,-1,1.25,b\n"
+           "2005,210,3000000000,-40000,,a\n")
+    df = datasets.load_bytes(csv.encode())
+    expected = pd.read_csv(io.StringIO(csv))
+
+    for col in ["year", "small", "wide", "neg"]:
+        assert df[col].tolist() == expected[col].tolist(), col
+    assert df["score"].astype(np.float64).tolist()[:2] == [0.5, 1.25]
+    assert df["score"].isna().tolist() == [False, False, True]
+    assert df["label"].astype(str).tolist() == ["a", "b", "a"]
+
+
+def test_ingest_picks_smallest_type_that_fits():
+    csv = "year,small,tiny\n1990,200,1\n2020,250,-3\n"
+    df = datasets.load_bytes(csv.encode())
+    assert df["year"].dtype == np.int16
+    assert df["small"].dtype == np.int16
+    assert df["tiny"].dtype == np.int8
+
+
+def test_ingest_keeps_large_ints_of_a_column_that_turns_float(monkeypatch):
+    # The first chunk only has ints above 2**24, which float32 can't hold exactly
+    monkeypatch.setattr(datasets, "CHUNK_ROWS", 2)
+    df = datasets.load_bytes(b"id,label\n16777217,a\n16777219,b\n,c\n0.5,d\n")
+    assert df["id"].dtype == np.float64
+    assert df["id"].tolist()[:2] == [16777217.0, 16777219.0]
+    assert np.isnan(df["id"].iloc[2]) and df["id"].iloc[3] == 0.5
+
+
+def test_cached_columns_are_mapped_without_a_copy(monkeypatch):
+    monkeypatch.setattr(datasets, "CHUNK_ROWS", 2)
+    digest = datasets.load_bytes(b"age,score,label\n30,0.5,a\n41,,b\n52,2.5,a\n").attrs[datasets.HASH_ATTR]
+    monkeypatch.setattr(datasets, "_frames", type(datasets._frames)())
+    df = datasets.load_hash(digest)
+    for values in (df["age"].to_numpy(), df["score"].to_numpy(), df["label"].cat.codes.to_numpy()):
+        assert not values.flags.owndata and not values.flags.writeable
+    assert np.isnan(df["score"].iloc[1])
+
+
+class Upload(io.BytesIO):
+    # Like Streamlit's UploadedFile: a file object with an ID per upload
+    file_id = "upload-1"
+
+
+def test_uploads_are_hashed_once_per_file_id(monkeypatch):
+    digests = {}
+    first = datasets.load_upload(Upload(b"a,b\n1,x\n2,y\n"), digests)
+    assert digests == {"upload-1": first.attrs[datasets.HASH_ATTR]}
+
+    def read_again(f):
+        raise AssertionError("the upload was hashed again")
+    monkeypatch.setattr(datasets, "content_hash", read_again)
+    assert datasets.load_upload(Upload(b"a,b\n1,x\n2,y\n"), digests) is first
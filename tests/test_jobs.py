@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+import jobs
+
+
+@pytest.fixture(autouse=True)
+def pool(cache_dir, monkeypatch):
+    # Spawned workers read the cache directory from the environment
+    monkeypatch.setenv("SD_RISK_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(jobs, "_futures", {})
+    monkeypatch.setattr(jobs, "_owners", {})
+    yield
+    if jobs._executor is not None:
+        jobs._executor.shutdown()
+        jobs._executor = None
+
+
+def test_failed_job_survives_later_submits_until_it_is_read():
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    failing = jobs.submit("builtins.int", (df,), {}, profile=False)
+    with pytest.raises(TypeError):
+        jobs.wait(failing, poll=0.05)
+    failing = jobs.submit("builtins.int", (df,), {}, profile=False, user="someone")
+    jobs._futures[failing].exception()
+
+    ok = jobs.submit("builtins.len", (df,), {}, profile=False)
+    assert jobs.wait(ok, poll=0.05) == 3
+    assert jobs.status(failing) == "failed"
+    with pytest.raises(TypeError):
+        jobs.wait(failing, poll=0.05)
+    # Once its error has been raised the failed job is forgotten
+    assert jobs.status(failing) == "unknown"
+    assert jobs.wait(failing, poll=0.05) is None
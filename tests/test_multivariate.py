@@ -0,0 +1,31 @@
+import adaptive
+import multivariate
+
+from conftest import make_table
+
+
+def test_search_within_small_memory_bounds_finds_the_same_queries(monkeypatch):
+    syn = make_table(3000, 0)
+    expected = [str(q) for q in multivariate.search(syn, 200, seed=1)["queries"]]
+
+    # A bank of a few bitmasks and batches of a few candidates
+    monkeypatch.setattr(multivariate, "_searcher", None)
+    monkeypatch.setattr(multivariate, "BANK_MB", 5 * 375 / 2 ** 20)
+    monkeypatch.setattr(multivariate, "BATCH_MB", 2 * 375 / 2 ** 20)
+    searcher = multivariate._Searcher(multivariate._polars(syn), multivariate.N_COLS)
+    assert searcher.batch == 1
+    assert [str(q) for q in multivariate.search(syn, 200, seed=1)["queries"]] == expected
+    assert multivariate._searcher[1]._bank.shape[0] <= 5
+
+
+def test_adaptive_multivariate_uses_the_bitmask_search(monkeypatch):
+    ori, syn, control = make_table(2000, 0), make_table(2000, 1), make_table(2000, 2)
+    calls = []
+    search = multivariate.search
+    monkeypatch.setattr(multivariate, "search", lambda *args, **kwargs: calls.append(kwargs) or search(*args, **kwargs))
+
+    record = adaptive.singling_out(ori, syn, control, tolerance=0.5, max_attacks=200, mode="multivariate",
+                                   time_budget=60)
+    assert calls and all(0 < call["time_budget"] <= 60 for call in calls)
+    assert record["search"]["complete"]
+    assert len(record["queries"]) == record["results"].n_attacks_ori
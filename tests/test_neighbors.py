@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import encoding
+import neighbors
+
+from conftest import make_table
+
+
+def brute_force(enc, cols, rows, k):
+    # Searched at the index width, so that ties are broken the same way
+    idx = encoding.column_index(enc, cols)
+    return encoding.kneighbors(np.asarray(enc["targets"][rows][:, idx]), np.ascontiguousarray(enc["syn"][:, idx]),
+                               enc["is_num"][idx], neighbors.K_MAX)[:, :k]
+
+
+def test_lookup_stores_only_the_queried_targets(monkeypatch):
+    ori, syn, control = make_table(3000, 0), make_table(500, 1), make_table(3000, 2)
+    enc = encoding.encode(ori, syn, control)
+    cols = ["age", "job"]
+    monkeypatch.setattr(neighbors, "MAX_CHUNKS", 3)
+
+    batches = [np.arange(0, 50), np.arange(40, 90), np.array([5000, 7, 5999]), np.arange(100, 120), np.arange(200, 210)]
+    for rows in batches:
+        got = neighbors.lookup(enc, cols, rows, 5)
+        assert np.array_equal(got, brute_force(enc, cols, rows, 5))
+
+    queried = np.unique(np.concatenate(batches))
+    assert np.array_equal(neighbors.create(enc, cols).rows, queried)
+    path = neighbors._index_dir(enc, cols)
+    assert len(os.listdir(path)) <= neighbors.MAX_CHUNKS
+
+    # A fresh process reads the stored neighbours back instead of searching again
+    expected = brute_force(enc, cols, queried, 5)
+    monkeypatch.setattr(neighbors, "_indexes", {})
+    monkeypatch.setattr(encoding, "kneighbors", None)
+    assert np.array_equal(neighbors.lookup(enc, cols, queried, 5), expected)
+
+
+def test_appended_release_starts_from_the_parent_index():
+    ori, syn, control = make_table(2000, 0), make_table(400, 1), make_table(2000, 2)
+    parent = encoding.encode(ori, syn, control)
+    neighbors.lookup(parent, ["age", "income"], np.arange(0, 300), 10)
+
+    extended = pd.concat([syn, make_table(100, 3)], ignore_index=True)
+    enc = encoding.encode(ori, extended, control)
+    assert enc["parent"] == parent["key"]
+    assert np.array_equal(neighbors.create(enc, ["age", "income"]).rows, np.arange(0, 300))
+    rows = np.arange(250, 350)
+    assert np.array_equal(neighbors.lookup(enc, ["age", "income"], rows, 10),
+                          brute_force(enc, ["age", "income"], rows, 10))
@@ -0,0 +1,30 @@
+import time
+
+import numpy as np
+
+import profiling
+
+
+def test_stage_memory_is_measured_during_the_stage():
+    with profiling.collect() as stages:
+        with profiling.stage("large"):
+            block = np.ones(200 * 2 ** 20, dtype=np.uint8)
+            time.sleep(3 * profiling.SAMPLE_SECONDS)
+            del block
+        with profiling.stage("small"):
+            time.sleep(3 * profiling.SAMPLE_SECONDS)
+    large, small = stages
+
+    assert large["rss_increase_mb"] > 150
+    # A later stage doesn't inherit the peak of an earlier one, unlike ru_maxrss
+    assert small["rss_increase_mb"] < 50
+    assert small["peak_rss_mb"] < large["peak_rss_mb"] - 150
+    assert profiling._process_peak_rss_mb() >= large["peak_rss_mb"] - 1
+
+
+def test_metrics_expose_the_stage_memory():
+    with profiling.stage("metrics_probe"):
+        pass
+    text = profiling.metrics_text()
+    assert 'sd_risk_stage_peak_rss_megabytes{stage="metrics_probe"}' in text
+    assert 'sd_risk_stage_rss_increase_megabytes{stage="metrics_probe"}' in text
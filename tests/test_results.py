@@ -0,0 +1,19 @@
+import os
+
+import results
+
+
+def test_report_store_is_bounded(monkeypatch):
+    monkeypatch.setattr(results, "REPORTS_BYTES", 1024 * 1024)
+    for i, key in enumerate(["a", "b", "c"]):
+        results.put(key, {"payload": bytes(400 * 1024)}, report=True)
+        os.utime(results._report_path(key), (i, i))
+    results.put("d", {"payload": bytes(400 * 1024)}, report=True)
+
+    monkeypatch.setattr(results, "_results", type(results._results)())
+    # The least recently used report is dropped, the results tier is untouched
+    assert results.get("a") is None
+    assert results.get("d") is not None
+    assert sum(os.path.getsize(os.path.join(results._reports_dir(), name))
+               for name in os.listdir(results._reports_dir())) <= results.REPORTS_BYTES
+    assert os.listdir(results._results_dir()) == []
@@ -0,0 +1,39 @@
+import pytest
+from anonymeter.stats.confidence import EvaluationResults
+
+import engine
+import results
+import sampling
+import stats
+
+from conftest import make_synthetic, make_table
+
+
+@pytest.mark.parametrize("n_success, n_control", [(30, 10), (48, 50)])
+def test_attacks_for_width_matches_the_wilson_interval(n_success, n_control):
+    # (48, 50) has a residual risk below 0, whose clipped CI is much narrower than the real one
+    res = EvaluationResults(n_attacks=100, n_success=n_success, n_baseline=5, n_control=n_control)
+    n = sampling.attacks_for_width(res, 0.1, 100000)
+    at = lambda k: stats.width(EvaluationResults(n_attacks=k, n_success=n_success / 100 * k, n_baseline=0,
+                                                 n_control=n_control / 100 * k))
+    assert at(n) <= 0.1
+    assert at(n - 1) > 0.1
+    assert sampling.attacks_for_width(res, 0.001, 500) == 500
+
+
+def test_fast_estimate_lands_within_the_full_run_ci():
+    ori, control = make_table(4000, 0), make_table(4000, 1)
+    syn = make_synthetic(ori, 2)
+    params = {"n_attacks": 3000, "aux_cols": [["age", "job"], ["income", "city"]], "n_neighbors": 5}
+
+    record = engine.linkability(ori, syn, control, **params)
+    full = record["results"].risk()
+    # Stored under its job ID, like a full run submitted from the app
+    results.put(results.make_key("linkability", (ori, syn, control), params), record)
+
+    estimate = sampling.fast_estimate(ori, syn, control, "linkability", params, target_width=0.04)
+    last = estimate["rounds"][-1]
+    assert last["n_attacks"] <= sampling.MAX_FRACTION * params["n_attacks"]
+    assert full.ci[0] <= last["risk"] <= full.ci[1]
+    assert last["ci"][0] <= full.value <= last["ci"][1]
+    assert estimate["bias"] == pytest.approx(last["risk"] - full.value)
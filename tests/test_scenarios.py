@@ -0,0 +1,25 @@
+import math
+import time
+
+import scenarios
+
+
+def test_small_generators_list_every_scenario():
+    columns = ["a", "b", "c", "d"]
+    splits = scenarios.generate("linkability", columns, "k_subsets", k=2)
+    # An even split is only counted once
+    assert len(splits) == math.comb(4, 2) // 2
+    assert len(scenarios.generate("inference", columns, "k_subsets", k=2)) == 4 * math.comb(3, 2)
+
+
+def test_wide_tables_draw_scenarios_without_listing_all_subsets():
+    columns = [f"c{i}" for i in range(30)]
+    start = time.monotonic()
+    links = scenarios.generate("linkability", columns, "k_subsets", k=10, limit=64)
+    inference = scenarios.generate("inference", columns, "k_subsets", k=10, limit=64)
+    assert time.monotonic() - start < 5
+    assert len(links) == len({s["label"] for s in links}) == 64
+    assert all(len(s["aux_cols"][0]) == 10 and len(s["aux_cols"][1]) == 20 for s in links)
+    assert len(inference) == 64
+    assert all(s["secret"] not in s["aux_cols"] for s in inference)
+    assert scenarios.generate("linkability", columns, "k_subsets", k=10, limit=64) == links
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from anonymeter.stats.confidence import EvaluationResults
+
+import stats
+
+
+def test_width_is_taken_before_clipping():
+    # Residual risk below 0: the clipped CI is less than half as wide as the real one
+    res = EvaluationResults(n_attacks=100, n_success=48, n_baseline=0, n_control=50)
+    clipped = res.risk().ci
+    value, lower, upper = stats.rates(100, 48, 100, 50, clip=False)
+    assert value < 0 and lower < 0
+    assert stats.width(res) == pytest.approx(upper - lower)
+    assert stats.width(res) > 2 * (clipped[1] - clipped[0])
+
+
+COUNTS = [
+    {"n_attacks": 500, "n_success": 140, "n_baseline": 12},
+    {"n_attacks": 500, "n_success": 140, "n_baseline": 12, "n_control": 60},
+    # Different numbers of attacks on the original, baseline and control targets
+    {"n_attacks": (400, 300, 200), "n_success": 90, "n_baseline": 5, "n_control": 10},
+    # Singling out corrects the control count for the size of the control data
+    {"n_attacks": 300, "n_success": 40, "n_baseline": 3, "n_control": 47.5},
+    # Residual risk below 0, clipped
+    {"n_attacks": 100, "n_success": 48, "n_baseline": 2, "n_control": 50},
+]
+
+
+@pytest.mark.parametrize("counts", COUNTS)
+@pytest.mark.parametrize("confidence_level", [0.8, 0.95, 0.99])
+@pytest.mark.parametrize("baseline", [False, True])
+def test_risk_matches_anonymeter(counts, confidence_level, baseline):
+    expected = EvaluationResults(**counts, confidence_level=confidence_level).risk(baseline=baseline)
+    res = EvaluationResults(**counts)
+    risk = stats.risk(res, confidence_level, baseline=baseline)
+    assert risk.value == pytest.approx(expected.value)
+    assert risk.ci == pytest.approx(expected.ci)
+
+
+def test_rates_broadcast_like_risk_of_each_count():
+    n_success = np.array([20, 60, 140])
+    values, lower, upper = stats.rates(500, n_success, 500, 60, confidence_level=0.9)
+    for i, n in enumerate(n_success):
+        expected = EvaluationResults(n_attacks=500, n_success=n, n_baseline=0, n_control=60,
+                                     confidence_level=0.9).risk()
+        assert (values[i], lower[i], upper[i]) == pytest.approx((expected.value, *expected.ci))
+
+
+def test_bootstrap_interval_covers_the_risk():
+    res = EvaluationResults(n_attacks=1000, n_success=300, n_baseline=20, n_control=100)
+    risk = stats.risk(res)
+    out = stats.bootstrap(res, n_resamples=2000)
+    low, high = out["ci"]
+    assert len(out["risks"]) == 2000
+    assert 0 <= low < risk.value < high <= 1
+    assert np.mean(out["risks"]) == pytest.approx(risk.value, abs=0.01)
+    # Narrower at a lower confidence level, and reproducible with the same seed
+    narrow = stats.bootstrap(res, n_resamples=2000, confidence_level=0.5)["ci"]
+    assert low < narrow[0] < narrow[1] < high
+    assert stats.bootstrap(res, n_resamples=2000)["ci"] == out["ci"]
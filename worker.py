@@ -0,0 +1,96 @@
+# Evaluation worker for the multi-user deployment.
+#
+# Claims jobs from the broker (SD_RISK_BROKER, see broker.py), runs them and
+# stores the records in the shared results store. Every worker process runs
+# one job at a time; scale with --processes or with more containers:
+#
+#     SD_RISK_BROKER=sqlite:////data/broker.sqlite python worker.py --processes 4
+#
+# The datasets, results and reports are exchanged through SD_RISK_CACHE_DIR, so
+# the UI and all workers must share it.
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import broker
+import jobs
+import profiling
+import results
+
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 10
+
+
+def _heartbeat(queue, job_id, done):
+    while not done.wait(HEARTBEAT_SECONDS):
+        queue.heartbeat(job_id)
+
+
+def run_job(queue, job_id, job):
+    """Run one claimed job and report its outcome to the broker."""
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(queue, job_id, done), daemon=True).start()
+    profiling.log_event("job_started", job=job_id, kind=job["kind"])
+    try:
+        out = jobs._run(job["kind"], job["hashes"], job["params"], job["profile_path"])
+    except Exception as ex:
+        queue.fail(job_id, ex)
+        profiling.log_event("job_failed", job=job_id, kind=job["kind"], error=repr(ex))
+    else:
+        results.put(job_id, out["record"], report=True)
+        queue.complete(job_id, out["stages"])
+        if not profiling._is_observer():
+            # Started by --processes: log the stages here, nobody else will
+            profiling.observe(out["stages"])
+        profiling.log_event("job_done", job=job_id, kind=job["kind"])
+    finally:
+        done.set()
+
+
+def loop(cpus, once=False):
+    """Claim and run jobs until interrupted, or until the queue is empty with `once`."""
+    queue = broker.connect()
+    if queue is None:
+        raise SystemExit("Set SD_RISK_BROKER to the broker shared with the app, e.g. sqlite:////data/broker.sqlite")
+    jobs._init_worker(cpus)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        queue.requeue_stale()
+        claimed = queue.claim(name)
+        if claimed is None:
+            if once:
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        run_job(queue, *claimed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run queued risk evaluations.")
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("SD_RISK_WORKERS", "1")),
+                        help="Worker processes, each running one evaluation at a time")
+    parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+    args = parser.parse_args(argv)
+
+    # Metrics of this container's workers, if SD_RISK_METRICS_PORT is set
+    profiling.serve_metrics()
+    cpus = max(1, jobs.MAX_CPUS // args.processes)
+    if args.processes == 1:
+        loop(cpus, args.once)
+        return 0
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=loop, args=(cpus, args.once)) for _ in range(args.processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())